@@ -0,0 +1,527 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+
+import deception_detection
+from deception_detection import DetectorSession, MAX_FRAMES
+from emotion import MOOD_RATE
+import tracing
+from tracing import span
+
+HOST = '127.0.0.1'
+PORT = 8765
+MAX_SESSIONS = 8
+FRAME_QUEUE = 4  # frames waiting per session before the oldest is dropped (or new ones rejected)
+EVENT_QUEUE = 256  # events waiting for a slow client before the oldest is dropped
+MAX_BODY = 32 * 1024 * 1024
+END_OF_STREAM = object()
+STOP = object()
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC11B3E'
+OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+CLOSE_NORMAL, CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG = 1000, 1002, 1009
+
+
+class RequestError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+class WebSocketError(Exception):
+    # ends an upgraded connection with a close frame carrying `code`, as it no longer speaks HTTP
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def response(status, payload=None, headers=()):
+    body = b'' if payload is None else json.dumps(payload).encode()
+    lines = ['HTTP/1.1 {} {}'.format(status, HTTPStatus(status).phrase)]
+    if status >= 200:
+        lines.append('Content-Length: {}'.format(len(body)))
+    if payload is not None:
+        lines.append('Content-Type: application/json')
+    lines += ['{}: {}'.format(name, value) for name, value in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+async def read_request(reader):
+    # (method, path, headers, body) of the next request, or None once the client hung up
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    except asyncio.LimitOverrunError:
+        raise RequestError(431)
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise RequestError(400)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    if 'transfer-encoding' in headers:
+        raise RequestError(411)
+    length = headers.get('content-length') or '0'
+    if not length.isdigit():
+        raise RequestError(400, 'Invalid Content-Length')
+    length = int(length)
+    if length > MAX_BODY:
+        raise RequestError(413)
+    body = await reader.readexactly(length) if length else b''
+    return method, urlsplit(target).path, headers, body
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+
+
+def websocket_frame(opcode, payload=b''):
+    # server frames are sent unmasked and unfragmented
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_message(reader, writer):
+    # (opcode, payload) of the next text, binary or close message; answers pings on the way
+    opcode, message = None, bytearray()
+    while True:
+        first, second = await reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack('!H', await reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await reader.readexactly(8))
+        if len(message) + length > MAX_BODY:
+            raise WebSocketError(CLOSE_TOO_BIG, 'Message too big')
+        if not second & 0x80:
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Client frames must be masked')
+        frame_opcode = first & 0x0F
+        # a data frame is a continuation exactly when a fragmented message has been started
+        if frame_opcode not in (OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG) or \
+                (frame_opcode < OP_CLOSE and (frame_opcode == OP_CONTINUATION) == (opcode is None)):
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Unexpected frame')
+        mask = await reader.readexactly(4)
+        payload = await reader.readexactly(length)
+        if length:
+            payload = (np.frombuffer(payload, np.uint8) ^ np.resize(np.frombuffer(mask, np.uint8), length)).tobytes()
+        if frame_opcode == OP_PING:
+            writer.write(websocket_frame(OP_PONG, payload))
+            continue
+        if frame_opcode == OP_PONG:
+            continue
+        if frame_opcode == OP_CLOSE:
+            return OP_CLOSE, payload
+        if frame_opcode != OP_CONTINUATION:
+            opcode = frame_opcode
+        message += payload
+        if first & 0x80:
+            return opcode, bytes(message)
+
+
+class ServiceSession:
+    # One analyzed subject: a DetectorSession fed in order by its own task from a bounded
+    # queue of frames, pushed by the client or read from a video file. Pushed frames never
+    # wait: when the queue is full the oldest is dropped, or with the 'reject' policy the new
+    # one is refused, so a client sending faster than inference keeps a bounded delay.
+    # File frames wait for room instead, so every frame is analyzed. Results go to a bounded
+    # queue of events, dropping the oldest when the client does not read them in time.
+    def __init__(self, session_id, executor, queue_size=FRAME_QUEUE, policy='drop', fps=30, ttl_for_tells=30, mood=True, roi=False, keyframe_interval=1):
+        self.id = session_id
+        self.executor = executor
+        self.policy = policy
+        self.fps = fps
+        self.ttl_for_tells = ttl_for_tells
+        self.detector = DetectorSession(mood_rate=MOOD_RATE if mood else 0, roi=roi, keyframe_interval=keyframe_interval)
+        self.frames = asyncio.Queue(queue_size)
+        self.events = asyncio.Queue(EVENT_QUEUE)
+        self.frame_index = 0
+        self.origin = None  # capture time of the first pushed frame
+        self.dropped_frames = 0
+        self.rejected_frames = 0
+        self.dropped_events = 0
+        self.file_task = None
+        self.listener = None  # the WebSocket connection events are streamed to
+        self.task = asyncio.create_task(self.run())
+
+    def info(self):
+        return {
+            'id': self.id,
+            'events': '/sessions/{}/events'.format(self.id),
+            'frames': self.frame_index,
+            'queued_frames': self.frames.qsize(),
+            'dropped_frames': self.dropped_frames,
+            'rejected_frames': self.rejected_frames,
+            'dropped_events': self.dropped_events,
+            'analyzing_file': self.file_task is not None and not self.file_task.done(),
+        }
+
+    def push(self, data, timestamp=None):
+        # queues an encoded frame; False when it was rejected
+        if self.file_task is not None and not self.file_task.done():
+            raise RequestError(409, 'A file is being analyzed in this session')
+        if self.frames.full():
+            if self.policy == 'reject':
+                self.rejected_frames += 1
+                return False
+            self.frames.get_nowait()
+            self.dropped_frames += 1
+        timestamp = timestamp if timestamp is not None else time.time()
+        if self.origin is None:
+            self.origin = timestamp
+        self.frames.put_nowait((timestamp, self.fps, data, timestamp - self.origin))
+        return True
+
+    def submit_file(self, path):
+        if self.file_task is not None and not self.file_task.done():
+            raise RequestError(409, 'A file is already being analyzed in this session')
+        if self.origin is not None:  # file frames are timed in frames, which would run behind the pushed frames' clock
+            raise RequestError(409, 'Frames were pushed to this session, open a new session to analyze a file')
+        if not os.path.isfile(path):
+            raise RequestError(404, 'No such file: {}'.format(path))
+        self.file_task = asyncio.create_task(self.read_file(path))
+
+    async def read_file(self, path):
+        # The capture is only used from a thread of its own. When the task is cancelled, a
+        # read already running there finishes first, and the release queued behind it
+        # cannot free the capture while it is in use.
+        loop = asyncio.get_running_loop()
+        reader = ThreadPoolExecutor(1, thread_name_prefix='file')
+        cap = None
+        try:
+            cap = await loop.run_in_executor(reader, cv2.VideoCapture, path)
+            if not cap.isOpened():
+                self.publish({'type': 'error', 'error': 'Could not open video file: {}'.format(path)})
+                return
+            fps = cap.get(cv2.CAP_PROP_FPS) or 30
+            index = 0
+            while True:
+                ret, frame = await loop.run_in_executor(reader, cap.read)
+                if not ret:
+                    break
+                await self.frames.put((None, fps, frame, index / fps))  # time counted in frames, as offline_analysis does
+                index += 1
+            await self.frames.put(END_OF_STREAM)
+        finally:
+            if cap is not None:
+                reader.submit(cap.release)
+            reader.shutdown(wait=False)
+
+    def publish(self, event):
+        if self.events.full():
+            self.events.get_nowait()
+            self.dropped_events += 1
+        self.events.put_nowait(event)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.frames.get()
+            if item is STOP:
+                return
+            if item is END_OF_STREAM:
+                self.publish({'type': 'end', 'frames': self.frame_index})
+                continue
+            try:
+                event = await loop.run_in_executor(self.executor, self.analyze, *item)
+            except Exception as error:
+                event = {'type': 'error', 'error': repr(error)}
+            self.publish(event)
+
+    def analyze(self, timestamp, fps, frame, seconds):
+        # runs on an inference thread, one frame of this session at a time; seconds is the
+        # frame's time from the start of its stream (the file, or the first pushed frame)
+        if isinstance(frame, bytes):
+            with span('decode'):
+                frame = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                return {'type': 'error', 'error': 'Could not decode frame'}
+        face_landmarks, hands_landmarks = self.detector.find_face_and_hands(frame)
+        calibrated = self.frame_index >= MAX_FRAMES
+        tells = self.detector.process_frame(frame, face_landmarks, hands_landmarks, calibrated, fps=fps, ttl_for_tells=self.ttl_for_tells, timestamp=timestamp)
+        event = {
+            'type': 'frame',
+            'frame': self.frame_index,
+            'time': round(seconds, 3),
+            'face': face_landmarks is not None,
+            'calibrated': calibrated,
+            'bpm': self.detector.bpm,
+            'mood': self.detector.mood or None,
+            'tells': {key: tell['text'] for key, tell in tells.items()},
+        }
+        self.frame_index += 1
+        return event
+
+    async def close(self):
+        # lets the frame being analyzed finish before the models go back to the pool
+        if self.file_task is not None:
+            self.file_task.cancel()
+            await asyncio.gather(self.file_task, return_exceptions=True)
+        while not self.frames.empty():
+            self.frames.get_nowait()
+        self.frames.put_nowait(STOP)
+        await self.task
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.detector.close)
+
+
+class AnalysisService:
+    # HTTP and WebSocket front end for concurrent sessions on one host. Inference for all of
+    # them runs on a pool of `workers` threads; each session has at most one frame in it at
+    # a time, so sessions take turns and see their frames in order.
+    def __init__(self, workers=None, max_sessions=MAX_SESSIONS, queue_size=FRAME_QUEUE, policy='drop', mood=True, ttl_for_tells=30):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='inference')
+        self.max_sessions = max_sessions
+        self.queue_size = queue_size
+        self.policy = policy
+        self.mood = mood
+        self.ttl_for_tells = ttl_for_tells
+        self.sessions = {}
+        self.server = None
+
+    async def start(self, host=HOST, port=PORT):
+        # returns the port listened on, so port 0 picks a free one
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        warming = asyncio.get_running_loop().run_in_executor(self.executor, deception_detection.warm_up, self.mood)
+        warming.add_done_callback(report_warm_up)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for session in list(self.sessions.values()):
+            await self.close_session(session)
+        self.executor.shutdown()
+        deception_detection.model_pool.close()
+
+    def create_session(self, options):
+        if len(self.sessions) >= self.max_sessions:
+            raise RequestError(503, 'Too many sessions')
+        policy = options.get('policy', self.policy)
+        if policy not in ('drop', 'reject'):
+            raise RequestError(400, 'policy must be "drop" or "reject"')
+        try:
+            queue_size = int(options.get('queue', self.queue_size))
+            settings = {
+                'fps': float(options.get('fps', 30)),
+                'ttl_for_tells': int(options.get('ttl', self.ttl_for_tells)),
+                'mood': bool(options.get('mood', self.mood)),
+                'roi': bool(options.get('roi', False)),
+                'keyframe_interval': int(options.get('keyframes', 1)),
+            }
+        except (TypeError, ValueError):  # e.g. null or a list instead of a number
+            raise RequestError(400, 'queue, fps, ttl and keyframes must be numbers')
+        if queue_size < 1:  # asyncio.Queue would be unbounded
+            raise RequestError(400, 'queue must be at least 1')
+        session = ServiceSession(uuid.uuid4().hex, self.executor, queue_size=queue_size, policy=policy, **settings)
+        self.sessions[session.id] = session
+        return session
+
+    async def close_session(self, session):
+        self.sessions.pop(session.id, None)
+        await session.close()
+        session.publish({'type': 'closed', 'frames': session.frame_index})
+
+    def find_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise RequestError(404, 'No such session')
+        return session
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except RequestError as error:  # the rest of the request cannot be skipped reliably
+                    writer.write(response(error.status, {'error': str(error)}))
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                try:
+                    if headers.get('upgrade', '').lower() == 'websocket':
+                        await self.websocket(path, headers, reader, writer)
+                        break
+                    status, payload = await self.route(method, path.rstrip('/').split('/')[1:], headers, body)
+                except RequestError as error:
+                    status, payload = error.status, {'error': str(error)}
+                except ValueError as error:
+                    status, payload = 400, {'error': str(error)}
+                writer.write(response(status, payload))
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, parts, headers, body):
+        # (status, JSON payload) for a plain HTTP request
+        if parts == ['health'] and method == 'GET':
+            return 200, {'sessions': len(self.sessions), 'workers': self.workers, 'max_sessions': self.max_sessions}
+        if parts == ['sessions'] and method == 'POST':
+            return 201, self.create_session(parse_json(body)).info()
+        if parts == ['sessions'] and method == 'GET':
+            return 200, [session.info() for session in self.sessions.values()]
+        if len(parts) < 2 or parts[0] != 'sessions':
+            raise RequestError(404)
+        session = self.find_session(parts[1])
+        action = parts[2] if len(parts) > 2 else None
+        if action is None and method == 'GET':
+            return 200, session.info()
+        if action is None and method == 'DELETE':
+            await self.close_session(session)
+            return 200, session.info()
+        if action == 'frames' and method == 'POST':
+            timestamp = float(headers['x-timestamp']) if 'x-timestamp' in headers else None
+            if not session.push(body, timestamp):
+                raise RequestError(429, 'Frame queue is full')
+            return 202, {'queued_frames': session.frames.qsize(), 'dropped_frames': session.dropped_frames}
+        if action == 'file' and method == 'POST':
+            path = parse_json(body).get('path')
+            if not path:
+                raise RequestError(400, 'path is required')
+            session.submit_file(path)
+            return 202, session.info()
+        if action == 'events' and method == 'GET':  # polling, for clients without WebSocket
+            events = []
+            while not session.events.empty():
+                events.append(session.events.get_nowait())
+            return 200, events
+        raise RequestError(405 if action in (None, 'frames', 'file', 'events') else 404)
+
+    async def websocket(self, path, headers, reader, writer):
+        # Streams a session's events as text messages. Binary messages from the client are
+        # encoded frames, text messages are JSON commands: {"type": "file", "path": ...}
+        # or {"type": "close"}.
+        parts = path.rstrip('/').split('/')[1:]
+        if len(parts) != 3 or parts[0] != 'sessions' or parts[2] != 'events' or 'sec-websocket-key' not in headers:
+            raise RequestError(404 if 'sec-websocket-key' in headers else 400)
+        session = self.find_session(parts[1])
+        if session.listener is not None:
+            raise RequestError(409, 'Events are already streamed to another client')
+        writer.write(response(101, headers=[('Upgrade', 'websocket'), ('Connection', 'Upgrade'),
+                                            ('Sec-WebSocket-Accept', accept_key(headers['sec-websocket-key']))]))
+        session.listener = writer
+        sender = asyncio.create_task(self.send_events(session, writer))
+        try:
+            while True:
+                opcode, message = await read_message(reader, writer)
+                if opcode == OP_CLOSE:
+                    writer.write(websocket_frame(OP_CLOSE, message[:2]))
+                    break
+                try:
+                    if opcode == OP_BINARY:
+                        if not session.push(message):
+                            session.publish({'type': 'rejected', 'rejected_frames': session.rejected_frames})
+                        continue
+                    command = parse_json(message)
+                    if command.get('type') == 'file':
+                        session.submit_file(command.get('path', ''))
+                    elif command.get('type') == 'close':
+                        await self.close_session(session)
+                        sender.cancel()
+                        while not session.events.empty():  # the last results and the 'closed' event
+                            writer.write(websocket_frame(OP_TEXT, json.dumps(session.events.get_nowait()).encode()))
+                        writer.write(websocket_frame(OP_CLOSE, struct.pack('!H', CLOSE_NORMAL)))
+                        break
+                    else:
+                        raise RequestError(400, 'Unknown command')
+                except RequestError as error:
+                    session.publish({'type': 'error', 'error': str(error)})
+        except WebSocketError as error:
+            writer.write(websocket_frame(OP_CLOSE, struct.pack('!H', error.code) + str(error).encode()))
+        finally:
+            sender.cancel()
+            session.listener = None
+
+    async def send_events(self, session, writer):
+        while True:
+            event = await session.events.get()
+            writer.write(websocket_frame(OP_TEXT, json.dumps(event).encode()))
+            await writer.drain()
+
+
+def report_warm_up(future):
+    # the models are loaded again by the first session; this only tells why it may fail
+    if not future.cancelled() and future.exception() is not None:
+        print("Could not load the models ahead of the first session: {!r}".format(future.exception()), file=sys.stderr)
+
+
+def parse_json(body):
+    if not body:
+        return {}
+    try:
+        value = json.loads(body)
+    except ValueError:
+        raise RequestError(400, 'Invalid JSON')
+    if not isinstance(value, dict):
+        raise RequestError(400, 'Expected a JSON object')
+    return value
+
+
+async def serve(host, port, **kwargs):
+    service = AnalysisService(**kwargs)
+    port = await service.start(host, port)
+    print("Listening on http://{}:{}".format(host, port), file=sys.stderr)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the detector over HTTP and WebSocket to several clients at once')
+    parser.add_argument('--host', '-a', help='Address to listen on, defaults to 127.0.0.1 (this machine only)', default=HOST)
+    parser.add_argument('--port', '-o', help='Port to listen on, defaults to 8765', default=str(PORT))
+    parser.add_argument('--workers', '-j', help='Frames analyzed at the same time across all sessions, defaults to the number of cores')
+    parser.add_argument('--sessions', '-s', help='Maximum number of open sessions, defaults to 8', default=str(MAX_SESSIONS))
+    parser.add_argument('--queue', '-q', help='Frames waiting per session before pushed frames are dropped or rejected, defaults to 4', default=str(FRAME_QUEUE))
+    parser.add_argument('--reject', '-r', help='Set to any value to reject new frames (HTTP 429) when a session\'s queue is full, instead of dropping the oldest')
+    parser.add_argument('--ttl', '-t', help='How many frames for each "tell" to last, defaults to 30', default='30')
+    parser.add_argument('--nomood', '-m', help='Set to any value to skip mood detection by default, which also skips loading TensorFlow')
+    parser.add_argument('--trace', '-p', help='Path of a Chrome/Perfetto trace file of timed spans to write on exit')
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable(args.trace)
+
+    try:
+        asyncio.run(serve(
+            args.host, int(args.port) if args.port.isdigit() else PORT,
+            workers=int(args.workers) if args.workers and args.workers.isdigit() else None,
+            max_sessions=int(args.sessions) if args.sessions.isdigit() else MAX_SESSIONS,
+            queue_size=int(args.queue) if args.queue.isdigit() and int(args.queue) > 0 else FRAME_QUEUE,
+            policy='drop' if args.reject is None else 'reject',
+            mood=args.nomood is None,
+            ttl_for_tells=int(args.ttl) if args.ttl.isdigit() else 30))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
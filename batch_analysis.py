@@ -0,0 +1,129 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+INDEX_FILE = 'index.jsonl'  # one line per finished video, appended as they finish
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']
+
+
+def find_videos(path):
+    # a directory (searched recursively) or a manifest file listing one video path per line
+    if os.path.isdir(path):
+        videos = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            videos += [os.path.join(root, name) for name in sorted(files) if name.lower().endswith(VIDEO_EXTENSIONS)]
+        return videos, path
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as manifest:
+        videos = [line.strip() for line in manifest if line.strip() and not line.startswith('#')]
+    return [video if os.path.isabs(video) else os.path.join(base, video) for video in videos], base
+
+
+def output_path(video, base, output_dir):
+    # mirrors the input layout, so videos with the same name in different folders do not collide
+    relative = os.path.relpath(os.path.abspath(video), os.path.abspath(base))
+    if relative.startswith('..'):
+        relative = os.path.basename(video)
+    return os.path.join(output_dir, relative + '.jsonl')
+
+
+def init_worker(threads):
+    import cv2
+    cv2.setNumThreads(threads)
+
+
+def worker_pool(processes, threads):
+    # Each worker runs its own models; pinning their thread pools keeps N workers from
+    # starting N times as many threads as there are cores. Workers are spawned, so they
+    # start from a clean interpreter instead of a copy of this one's threads. A spawned
+    # worker imports the parent's main module before any initializer runs, and numpy, BLAS
+    # and TensorFlow read the thread variables when imported, so they are set in the
+    # environment the workers inherit while the pool starts them.
+    saved = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    os.environ.update({variable: str(threads) for variable in THREAD_VARIABLES})
+    try:
+        return multiprocessing.get_context('spawn').Pool(processes, initializer=init_worker, initargs=(threads,))
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                del os.environ[variable]
+            else:
+                os.environ[variable] = value
+
+
+def analyze(job):
+    # runs in a worker process; the results only appear under their final name once complete
+    video, output, options = job
+    from offline_analysis import analyze_video
+    partial = output + '.partial'
+    started = time.time()
+    frames = 0
+    try:
+        with open(partial, 'w') as results:
+            for result in analyze_video(video, **options):
+                results.write(json.dumps(result) + '\n')
+                frames += 1
+        os.replace(partial, output)
+    except Exception as error:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return {'video': video, 'output': None, 'frames': frames, 'seconds': round(time.time() - started, 1), 'error': repr(error)}
+    return {'video': video, 'output': output, 'frames': frames, 'seconds': round(time.time() - started, 1), 'error': None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze every video in a directory or manifest on a pool of worker processes')
+    parser.add_argument('--input', '-i', required=True, help='Directory of videos (searched recursively) or a text file listing one video path per line')
+    parser.add_argument('--output', '-o', required=True, help='Directory for the JSON Lines results, one file per video; videos with results there already are skipped')
+    parser.add_argument('--workers', '-j', help='Number of worker processes, defaults to the number of cores divided by --threads')
+    parser.add_argument('--threads', '-p', help='Threads for each worker\'s models, defaults to 1', default='1')
+    parser.add_argument('--ttl', '-t', help='How many frames for each "tell" to last, defaults to 30', default='30')
+    parser.add_argument('--cache', '-n', help='Set to any value to keep each video\'s landmarks in the landmark cache, which batch runs skip by default')
+    parser.add_argument('--roi', '-c', help='Set to any value to run face and hand detection only on a crop around the tracked face')
+    parser.add_argument('--keyframes', '-k', help='Run face and hand detection every N frames and track landmarks with optical flow in between, defaults to 1 (every frame)', default='1')
+    parser.add_argument('--nomood', '-m', help='Set to any value to skip mood detection, which also skips loading TensorFlow')
+    args = parser.parse_args()
+
+    threads = int(args.threads) if args.threads.isdigit() else 1
+    workers = int(args.workers) if args.workers and args.workers.isdigit() else max(1, (os.cpu_count() or 1) // threads)
+    options = {
+        'ttl_for_tells': int(args.ttl) if args.ttl.isdigit() else 30,
+        'use_cache': args.cache is not None,  # an archive is analyzed once, its caches would only fill the disk
+        'roi': args.roi is not None,
+        'keyframe_interval': int(args.keyframes) if args.keyframes.isdigit() else 1,
+        'mood': args.nomood is None,
+    }
+
+    videos, base = find_videos(args.input)
+    jobs = []
+    for video in videos:
+        output = output_path(video, base, args.output)
+        if os.path.exists(output):
+            continue  # finished in an earlier run
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        jobs.append((video, output, options))
+    print("{} videos, {} already analyzed, {} workers".format(len(videos), len(videos) - len(jobs), workers), file=sys.stderr)
+    if not jobs:
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+    started = time.time()
+    failed = 0
+    with worker_pool(min(workers, len(jobs)), threads) as pool, \
+            open(os.path.join(args.output, INDEX_FILE), 'a') as index:
+        for done, result in enumerate(pool.imap_unordered(analyze, jobs), 1):
+            index.write(json.dumps(result) + '\n')
+            index.flush()
+            failed += result['error'] is not None
+            status = "failed: " + result['error'] if result['error'] else "{} frames in {}s".format(result['frames'], result['seconds'])
+            print("[{}/{}] {} - {}".format(done, len(jobs), result['video'], status), file=sys.stderr)
+    print("Analyzed {} videos in {:.1f}s ({} failed)".format(len(jobs) - failed, time.time() - started, failed), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
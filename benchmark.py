@@ -0,0 +1,305 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from deception_detection import DetectorSession, MAX_FRAMES, FACE_MESH_SETTINGS, HANDS_SETTINGS, get_emotion_detector
+from emotion import MOOD_RATE, crop_face, load_detector
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_INPUTS = ['1.mp4', '2.mp4', 'synthetic']
+SYNTHETIC_SIZE = (1280, 720)
+SYNTHETIC_FRAMES = 300
+SYNTHETIC_FPS = 30
+WARMUP_FRAMES = 10  # graph initialization and first allocations, left out of the statistics
+PERCENTILES = [50, 90, 99]
+STAGES = ['decode', 'color', 'facemesh', 'hands', 'fer', 'rppg', 'tells', 'render']
+# seconds until the menu is shown, then for each later step of loading an analysis session;
+# stops at the first step that fails, as the later ones depend on it
+STARTUP_SCRIPT = '''
+import json, sys, time
+
+def menu():
+    import main, pygame
+    pygame.init()
+    pygame.display.set_mode((main.screen_width, main.screen_height))
+
+def analysis_modules():
+    import video_processing
+
+def mediapipe():
+    import deception_detection
+    deception_detection.warm_up(mood=False)
+
+def mood_model():
+    import deception_detection
+    deception_detection.get_emotion_detector()
+
+steps = [menu, analysis_modules, mediapipe] + ([mood_model] if 'mood' in sys.argv[1:] else [])
+times, error = {}, None
+for step in steps:
+    started = time.perf_counter()
+    try:
+        step()
+    except Exception as exception:
+        error = '{}: {!r}'.format(step.__name__, exception)
+        break
+    times[step.__name__] = time.perf_counter() - started
+print(json.dumps({'times': times, 'error': error}))
+'''
+
+
+class StageTimes:
+    # Per-frame durations of each stage. Stages timed inside another one (the models inside
+    # landmark detection, FER and rPPG inside process_frame) are subtracted from it afterwards.
+    def __init__(self):
+        self.frame = {}
+        self.samples = {}
+        self.recording = False
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.frame[stage] = self.frame.get(stage, 0) + time.perf_counter() - started
+
+    def end_frame(self):
+        frame, self.frame = self.frame, {}
+        if 'landmarks' in frame:  # what is left is color conversion, cropping and tracking
+            frame['color'] = frame.pop('landmarks') - frame.get('facemesh', 0) - frame.get('hands', 0)
+        if 'process' in frame:
+            frame['tells'] = frame.pop('process') - frame.get('fer', 0) - frame.get('rppg', 0)
+        if self.recording:
+            for stage, seconds in frame.items():
+                self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        # milliseconds per frame in which the stage ran
+        stats = {}
+        for stage in STAGES:
+            if stage not in self.samples:
+                continue
+            samples = np.array(self.samples[stage]) * 1000
+            stats[stage] = {'count': len(samples), 'mean': round(float(samples.mean()), 3), 'max': round(float(samples.max()), 3)}
+            for percentile, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+                stats[stage]['p{}'.format(percentile)] = round(float(value), 3)
+        return stats
+
+
+class TimedModel:
+    # A MediaPipe graph whose process() calls are timed as `stage`
+    def __init__(self, model, stage, times):
+        self.model = model
+        self.stage = stage
+        self.times = times
+
+    def process(self, image):
+        with self.times.time(self.stage):
+            return self.model.process(image)
+
+    def close(self):
+        self.model.close()
+
+
+class BenchmarkSession(DetectorSession):
+    # Classifies mood on the analysis thread, at the rate the emotion worker would, so that
+    # FER shows up as a stage of its own instead of competing from a background thread.
+    def __init__(self, times, fps, **kwargs):
+        import mediapipe as mp
+        super().__init__(
+            face_mesh=TimedModel(mp.solutions.face_mesh.FaceMesh(**FACE_MESH_SETTINGS), 'facemesh', times),
+            hands=TimedModel(mp.solutions.hands.Hands(**HANDS_SETTINGS), 'hands', times),
+            **kwargs)
+        if self.face_roi:
+            self.roi_face_mesh = TimedModel(mp.solutions.face_mesh.FaceMesh(**FACE_MESH_SETTINGS), 'facemesh', times)
+            self.roi_hands = TimedModel(mp.solutions.hands.Hands(**HANDS_SETTINGS), 'hands', times)
+        self.times = times
+        self.mood_interval = max(int(round(fps / self.mood_rate)), 1) if self.mood_rate else None
+
+    def update_mood(self, image, face, timestamp=None):
+        if not self.mood_interval or self.frame_count % self.mood_interval:
+            return
+        detector = self.emotion_detector or load_detector(get_emotion_detector)
+        if detector is None:  # the failure is printed once, the benchmark goes on without FER
+            self.mood_interval = None
+            return
+        with self.times.time('fer'):
+            crop, face_rect = crop_face(image, face)
+            if crop is not None:
+                detector.detect_emotions(crop, face_rectangles=[face_rect])
+
+    def get_bpm_change_value(self, image, draw, face_landmarks, hands_landmarks, seconds):
+        with self.times.time('rppg'):
+            return super().get_bpm_change_value(image, draw, face_landmarks, hands_landmarks, seconds)
+
+
+class SyntheticSource:
+    # Moving noise without a face: the cost of the pipeline when nobody is in view
+    def __init__(self, size=SYNTHETIC_SIZE, frames=SYNTHETIC_FRAMES):
+        width, height = size
+        rng = np.random.default_rng(0)
+        self.frames = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(8)]
+        self.remaining = frames
+
+    def read(self):
+        if self.remaining <= 0:
+            return False, None
+        self.remaining -= 1
+        return True, self.frames[self.remaining % len(self.frames)]
+
+    def release(self):
+        pass
+
+
+def open_input(name, frames=None):
+    # returns (source, fps); "synthetic" or "synthetic:WIDTHxHEIGHT" for generated frames
+    if name.startswith('synthetic'):
+        size = SYNTHETIC_SIZE
+        if ':' in name:
+            size = tuple(int(value) for value in name.split(':', 1)[1].split('x'))
+        return SyntheticSource(size, frames or SYNTHETIC_FRAMES), SYNTHETIC_FPS
+    cap = cv2.VideoCapture(name)
+    if not cap.isOpened():
+        raise IOError("Could not open video file: {}".format(name))
+    return cap, cap.get(cv2.CAP_PROP_FPS) or 30
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)  # bytes on macOS, KB elsewhere
+
+
+def measure_startup(mood=True):
+    # in a fresh interpreter, so that nothing is imported yet; returns (seconds per step, error or None)
+    env = dict(os.environ, SDL_VIDEODRIVER='dummy', PYGAME_HIDE_SUPPORT_PROMPT='1')
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT] + (['mood'] if mood else []), cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, capture_output=True, text=True)
+    try:
+        output = json.loads(result.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):  # the interpreter itself died
+        stderr = result.stderr.strip().splitlines()
+        return {}, 'exit code {}: {}'.format(result.returncode, stderr[-1] if stderr else 'no output')
+    return {step: round(seconds, 3) for step, seconds in output['times'].items()}, output['error']
+
+
+def benchmark_input(name, max_frames=None, roi=False, keyframe_interval=1, render=True, draw_landmarks=False, mood_rate=MOOD_RATE, warmup=WARMUP_FRAMES):
+    source, fps = open_input(name, max_frames + warmup if max_frames else None)
+    times = StageTimes()
+    session = BenchmarkSession(times, fps, mood_rate=mood_rate, roi=roi, keyframe_interval=keyframe_interval)
+    renderer = None
+    if render:
+        import video_processing
+        renderer = video_processing.Renderer(video_processing.pygame.display.get_surface())
+    frames = 0
+    started = None
+    try:
+        while max_frames is None or frames < max_frames + warmup:
+            if frames == warmup:
+                times.recording = True
+                started = time.perf_counter()
+            with times.time('decode'):
+                ret, frame = source.read()
+            if not ret:
+                times.frame = {}
+                break
+            with times.time('landmarks'):
+                face_landmarks, hands_landmarks = session.find_face_and_hands(frame)
+            with times.time('process'):
+                tells = session.process_frame(frame, face_landmarks, hands_landmarks, frames >= MAX_FRAMES, fps=fps)
+            if renderer:
+                with times.time('render'):
+                    renderer.draw_frame(frame, face_landmarks, hands_landmarks, draw_landmarks)
+                    video_processing.draw_tells_on_frame(renderer, tells, video_processing.side_panel_width + 10, 50)
+                    renderer.present()
+            times.end_frame()
+            frames += 1
+    finally:
+        source.release()
+        session.close()
+    elapsed = time.perf_counter() - started if started is not None else 0
+    measured = max(frames - warmup, 0)
+    return {
+        'input': name,
+        'frames': measured,
+        'seconds': round(elapsed, 3),
+        'fps': round(measured / elapsed, 2) if elapsed else None,
+        'stages': times.summary(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def print_summary(result, output):
+    print("{input}: {frames} frames in {seconds}s ({fps} fps), peak RSS {peak_rss_mb} MB".format(**result), file=output)
+    print("  {:<10}{:>8}{:>10}{:>10}{:>10}{:>10}".format('stage', 'count', 'mean ms', 'p50', 'p90', 'p99'), file=output)
+    for stage, stats in result['stages'].items():
+        print("  {:<10}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(stage, stats['count'], stats['mean'], stats['p50'], stats['p90'], stats['p99']), file=output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-stage latency, throughput and memory of the analysis pipeline')
+    parser.add_argument('--input', '-i', nargs='*', help='Video files and/or "synthetic[:WIDTHxHEIGHT]" inputs, defaults to 1.mp4 2.mp4 synthetic', default=DEFAULT_INPUTS)
+    parser.add_argument('--output', '-o', help='Path of the JSON file to write, defaults to stdout')
+    parser.add_argument('--frames', '-f', help='Frames to measure per input after the warm-up, defaults to the whole input')
+    parser.add_argument('--roi', '-c', help='Set to any value to run face and hand detection only on a crop around the tracked face')
+    parser.add_argument('--keyframes', '-k', help='Run face and hand detection every N frames and track landmarks with optical flow in between, defaults to 1 (every frame)', default='1')
+    parser.add_argument('--norender', '-n', help='Set to any value to leave out drawing the playback view')
+    parser.add_argument('--landmarks', '-l', help='Set to any value to draw face and hand landmarks in the playback view')
+    parser.add_argument('--nomood', '-m', help='Set to any value to skip mood detection')
+    parser.add_argument('--nostartup', '-s', help='Set to any value to skip measuring the startup time')
+    args = parser.parse_args()
+
+    max_frames = int(args.frames) if args.frames and args.frames.isdigit() else None
+    keyframe_interval = int(args.keyframes) if args.keyframes.isdigit() else 1
+    render = args.norender is None
+    mood_rate = MOOD_RATE if args.nomood is None else 0
+    if render:  # drawn off screen
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        import pygame
+        pygame.init()
+        from video_processing import video_width, video_height, side_panel_width
+        pygame.display.set_mode((video_width + side_panel_width, video_height))
+
+    report = {
+        'config': {'roi': args.roi is not None, 'keyframes': keyframe_interval, 'render': render, 'landmarks': args.landmarks is not None, 'mood_rate': mood_rate},
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': [],
+    }
+    if args.nostartup is None:
+        report['startup'], error = measure_startup(mood_rate > 0)
+        summary = ", ".join("{} {:.2f}s".format(step, seconds) for step, seconds in report['startup'].items())
+        if error:
+            report['startup_error'] = error
+            summary += (", " if summary else "") + "failed at " + error
+        print("Startup: " + summary, file=sys.stderr)
+    for name in args.input:
+        result = benchmark_input(name, max_frames, args.roi is not None, keyframe_interval, render, args.landmarks is not None, mood_rate)
+        print_summary(result, sys.stderr)
+        report['results'].append(result)
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(report, output, indent=2)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
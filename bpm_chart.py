@@ -0,0 +1,78 @@
+import time
+
+import cv2
+import numpy as np
+from scipy.signal import find_peaks
+
+CHART_WIDTH = 480
+CHART_HEIGHT = 360
+CHART_FPS = 10  # redraws per second, whatever the processing rate
+MARGIN = 8
+COLOR_BACKGROUND = (20, 20, 20)
+COLOR_AXIS = (70, 70, 70)
+COLOR_TEXT = (255, 255, 255)
+COLOR_SIGNAL = (0, 200, 0)  # cheek green channel
+COLOR_PULSE = (255, 160, 0)
+COLOR_PEAK = (0, 0, 255)
+COLOR_BPM = (0, 200, 255)
+
+
+def to_points(values, rect):
+    # (n, 1, 2) pixel points of `values` stretched over rect = (x, y, width, height)
+    x, y, width, height = rect
+    low, high = values.min(), values.max()
+    scale = (height - 1) / (high - low) if high > low else 0
+    xs = x + np.arange(len(values)) * (width - 1) / max(len(values) - 1, 1)
+    ys = y + height - 1 - (values - low) * scale
+    return np.rint(np.stack((xs, ys), axis=1)).astype(np.int32).reshape(-1, 1, 2)
+
+
+class BpmChart:
+    # Live heart rate chart: the resampled cheek signal, the pulse signal of the last estimate
+    # with its beats marked, and the recent BPM estimates. The processing thread hands over a
+    # copy of the data at most CHART_FPS times a second (update), and the UI thread redraws
+    # the preallocated canvas only when a new copy has arrived (render).
+    def __init__(self, width=CHART_WIDTH, height=CHART_HEIGHT, fps=CHART_FPS):
+        self.canvas = np.empty((height, width, 3), dtype=np.uint8)
+        self.interval = 1.0 / fps
+        self.next_update = 0
+        self.snapshot = None
+        self.drawn = None
+        panel_height = (height - 4 * MARGIN) // 3
+        self.panels = [(MARGIN, MARGIN + i * (panel_height + MARGIN), width - 2 * MARGIN, panel_height) for i in range(3)]
+
+    def update(self, heart_rate):
+        now = time.time()
+        if now < self.next_update:
+            return
+        self.next_update = now + self.interval
+        _, colors = heart_rate.window()
+        self.snapshot = (colors[1].copy(), heart_rate.pulse, heart_rate.history.values(), heart_rate.bpm, heart_rate.rate, heart_rate.max_bpm)
+
+    def render(self):
+        # the redrawn chart, or None when nothing changed since the last call
+        snapshot = self.snapshot
+        if snapshot is None or snapshot is self.drawn:
+            return None
+        self.drawn = snapshot
+        signal, pulse, history, bpm, rate, max_bpm = snapshot
+        self.canvas[:] = COLOR_BACKGROUND
+        for x, y, width, height in self.panels:
+            cv2.rectangle(self.canvas, (x, y), (x + width - 1, y + height - 1), COLOR_AXIS, 1)
+
+        if len(signal) > 1:
+            cv2.polylines(self.canvas, [to_points(signal, self.panels[0])], False, COLOR_SIGNAL, 1, cv2.LINE_AA)
+        if pulse is not None and len(pulse) > 1:
+            points = to_points(pulse, self.panels[1])
+            cv2.polylines(self.canvas, [points], False, COLOR_PULSE, 1, cv2.LINE_AA)
+            peaks, _ = find_peaks(pulse, distance=max(int(rate * 60 / max_bpm), 1))
+            for point in points[peaks, 0]:
+                cv2.circle(self.canvas, tuple(point.tolist()), 3, COLOR_PEAK, -1)
+        history = history[np.isfinite(history)]
+        if len(history) > 1:
+            cv2.polylines(self.canvas, [to_points(history, self.panels[2])], False, COLOR_BPM, 2, cv2.LINE_AA)
+
+        labels = ["Cheek signal", "Pulse", "BPM: {}".format(int(bpm)) if bpm else "BPM: ..."]
+        for label, (x, y, _, _) in zip(labels, self.panels):
+            cv2.putText(self.canvas, label, (x + 4, y + 16), cv2.FONT_HERSHEY_SIMPLEX, .5, COLOR_TEXT, 1, cv2.LINE_AA)
+        return self.canvas
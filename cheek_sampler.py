@@ -0,0 +1,40 @@
+import cv2
+import numpy as np
+
+from landmarks import CHEEK_L, CHEEK_R
+
+CHEEKS = [CHEEK_L, CHEEK_R]
+
+
+def cheek_rects(face, width, height):
+    # (x1, y1, x2, y2) pixel boxes of both cheeks, between the averaged edges of each
+    # landmark quad and clipped to the frame; empty boxes are left out
+    corners = np.asarray(face)[CHEEKS, :2] * (width, height)  # (2, 4, 2): top left, top right, bottom right, bottom left
+    rects = []
+    for top_left, top_right, bottom_right, bottom_left in corners:
+        xs = sorted((int((top_left[0] + bottom_left[0]) / 2), int((top_right[0] + bottom_right[0]) / 2)))
+        ys = sorted((int((top_left[1] + top_right[1]) / 2), int((bottom_left[1] + bottom_right[1]) / 2)))
+        x1, x2 = max(xs[0], 0), min(xs[1], width)
+        y1, y2 = max(ys[0], 0), min(ys[1], height)
+        if x2 > x1 and y2 > y1:
+            rects.append((x1, y1, x2, y2))
+    return rects
+
+
+class CheekSampler:
+    # Mean colour of both cheeks for the heart rate signal. Each cheek is the box inside
+    # its landmark quad rather than the whole quad: the quad's slanted edges reach the eye
+    # bags and the side of the nose, whose shading moves with expressions and can outweigh
+    # the pulse (on 2.mp4 the quads read twice the heart rate). The boxes are summed in
+    # place with cv2.sumElems, so no pixels are copied.
+    def sample(self, image, face):
+        # returns the (B, G, R) mean, or None when the cheeks are outside the frame
+        height, width = image.shape[:2]
+        total = np.zeros(3)
+        pixels = 0
+        for x1, y1, x2, y2 in cheek_rects(face, width, height):
+            total += cv2.sumElems(image[y1:y2, x1:x2])[:3]
+            pixels += (x2 - x1) * (y2 - y1)
+        if not pixels:
+            return None
+        return total / pixels
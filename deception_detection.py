@@ -1,8 +1,14 @@
 import cv2
-import numpy as np
-from scipy.signal import find_peaks
-from scipy.spatial import distance as dist
-from fer import FER
+import landmarks
+from ring_buffer import RingBuffer
+from heart_rate import HeartRateMonitor
+from cheek_sampler import CheekSampler
+from emotion import EmotionWorker, FrameClockEmotion, MOOD_RATE, crop_face, load_detector
+from face_roi import FaceRoi
+from landmark_tracker import LandmarkTracker
+from model_pool import ModelPool
+from tracing import span
+from landmarks import face_to_array, hands_to_array, to_landmark_list, get_lip_ratio, get_face_relative_area
 import threading
 import time
 
@@ -15,24 +21,26 @@ LIP_COMPRESSION_RATIO = .35
 TEXT_HEIGHT = 30
 FACEMESH_FACE_OVAL = [10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 361, 288, 397, 365, 379, 378, 400, 377, 152, 148, 176, 149, 150, 136, 172, 58, 132, 93, 234, 127, 162, 21, 54, 103, 67, 109, 10]
 EPOCH = time.time()
+FACE_MESH_SETTINGS = {'max_num_faces': 1, 'refine_landmarks': True, 'min_detection_confidence': 0.5, 'min_tracking_confidence': 0.5}
+HANDS_SETTINGS = {'max_num_hands': 2, 'min_detection_confidence': 0.7}
 
-# Global variables for detection
-blinks = [False] * MAX_FRAMES
-hand_on_face = [False] * MAX_FRAMES
-face_area_size = 0
-hr_times = list(range(0, MAX_FRAMES))
-hr_values = [400] * MAX_FRAMES
-avg_bpms = [0] * MAX_FRAMES
-gaze_values = [0] * MAX_FRAMES
-emotion_detector = FER(mtcnn=True)
-calculating_mood = False
-mood = ''
-tells = dict()
-
-def decrement_tells(tells):
+# Models shared by every DetectorSession, loaded on first use
+model_pool = ModelPool(FACE_MESH_SETTINGS, HANDS_SETTINGS)
+emotion_lock = threading.Lock()
+
+def get_emotion_detector():
+    return model_pool.emotion_detector()
+
+def warm_up(mood=True):
+    # loads the models ahead of the first session, e.g. on a thread while a menu is shown
+    model_pool.warm_up()
+    if mood:
+        load_detector(get_emotion_detector)  # without fer, mood is disabled as in a session
+
+def decrement_tells(tells, frames=1):
     for key, tell in tells.copy().items():
         if 'ttl' in tell:
-            tell['ttl'] -= 1
+            tell['ttl'] -= frames
             if tell['ttl'] <= 0:
                 del tells[key]
     return tells
@@ -40,26 +48,12 @@ def decrement_tells(tells):
 def new_tell(result, ttl_for_tells):
     return {'text': result, 'ttl': ttl_for_tells}
 
-def smooth(signal, window_size):
-    window = np.ones(window_size) / window_size
-    return np.convolve(signal, window, mode='same')
-
-def calculate_bpm(signal, fps, min_bpm=50, max_bpm=150):
-    signal = smooth(signal, window_size=5)
-    peaks, _ = find_peaks(signal, distance=fps/2.5, height=0.05)
-    if len(peaks) < 2:
-        return None
-    peak_intervals = np.diff(peaks) / fps * 60
-    valid_peaks = peak_intervals[(peak_intervals >= min_bpm) & (peak_intervals <= max_bpm)]
-    if len(valid_peaks) == 0:
-        return None
-    return np.mean(valid_peaks)
-
 def draw_on_frame(image, face_landmarks, hands_landmarks):
     import mediapipe as mp
     mp_drawing = mp.solutions.drawing_utils
     mp_drawing_styles = mp.solutions.drawing_styles
-    if face_landmarks:
+    if face_landmarks is not None:
+        face_landmarks = to_landmark_list(face_landmarks)
         mp_drawing.draw_landmarks(
             image,
             face_landmarks,
@@ -78,17 +72,16 @@ def draw_on_frame(image, face_landmarks, hands_landmarks):
             mp.solutions.face_mesh.FACEMESH_IRISES,
             landmark_drawing_spec=None,
             connection_drawing_spec=mp_drawing_styles.get_default_face_mesh_iris_connections_style())
-    if hands_landmarks:
+    if hands_landmarks is not None:
         for hand_landmarks in hands_landmarks:
             mp_drawing.draw_landmarks(
                 image,
-                hand_landmarks,
+                to_landmark_list(hand_landmarks),
                 mp.solutions.hands.HAND_CONNECTIONS,
                 mp_drawing_styles.get_default_hand_landmarks_style(),
                 mp_drawing_styles.get_default_hand_connections_style())
 
-def add_text(image, tells, calibrated):
-    global mood
+def add_text(image, tells, calibrated, mood=''):
     text_y = TEXT_HEIGHT
     if mood:
         write("Mood: {}".format(mood), image, int(.75 * image.shape[1]), TEXT_HEIGHT)
@@ -105,31 +98,14 @@ def write(text, image, x, y):
                 fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=1, color=[255, 255, 255],
                 lineType=cv2.LINE_AA, thickness=2)
 
-def get_aspect_ratio(top, bottom, right, left):
-    height = dist.euclidean([top.x, top.y], [bottom.x, bottom.y])
-    width = dist.euclidean([right.x, right.y], [left.x, left.y])
-    return height / width
-
-def get_area(image, draw, topL, topR, bottomR, bottomL):
-    topY = int((topR.y + topL.y) / 2 * image.shape[0])
-    botY = int((bottomR.y + bottomL.y) / 2 * image.shape[0])
-    leftX = int((topL.x + bottomL.x) / 2 * image.shape[1])
-    rightX = int((topR.x + bottomR.x) / 2 * image.shape[1])
-    return image[topY:botY, rightX:leftX]
-
 def is_blinking(face):
-    eyeR = [face[p] for p in [159, 145, 133, 33]]
-    eyeR_ar = get_aspect_ratio(*eyeR)
-    eyeL = [face[p] for p in [386, 374, 362, 263]]
-    eyeL_ar = get_aspect_ratio(*eyeL)
-    eyeA_ar = (eyeR_ar + eyeL_ar) / 2
-    return eyeA_ar < EYE_BLINK_HEIGHT
+    return bool(landmarks.get_eye_ratio(face) < EYE_BLINK_HEIGHT)
 
 def get_blink_tell(blinks):
-    if sum(blinks[:RECENT_FRAMES]) < 3:
+    if blinks.head_sum() < 3:
         return None
-    recent_closed = 1.0 * sum(blinks[-RECENT_FRAMES:]) / RECENT_FRAMES
-    avg_closed = 1.0 * sum(blinks) / MAX_FRAMES
+    recent_closed = 1.0 * blinks.tail_sum() / RECENT_FRAMES
+    avg_closed = 1.0 * blinks.sum() / MAX_FRAMES
     if recent_closed > (20 * avg_closed):
         return "Increased blinking"
     elif avg_closed > (20 * recent_closed):
@@ -138,56 +114,26 @@ def get_blink_tell(blinks):
         return None
 
 def check_hand_on_face(hands_landmarks, face):
-    if hands_landmarks:
-        face_landmarks = [face[p] for p in FACEMESH_FACE_OVAL]
-        face_points = [[[p.x, p.y] for p in face_landmarks]]
-        face_contours = np.array(face_points).astype(np.single)
-        for hand_landmarks in hands_landmarks:
-            hand = []
-            for point in hand_landmarks.landmark:
-                hand.append((point.x, point.y))
-            for finger in [4, 8, 20]:
-                overlap = cv2.pointPolygonTest(face_contours, hand[finger], False)
-                if overlap != -1:
-                    return True
-    return False
+    if hands_landmarks is None:
+        return False
+    return bool(landmarks.get_hand_on_face(face, hands_landmarks))
 
 def get_avg_gaze(face):
-    gaze_left = get_gaze(face, 476, 474, 263, 362)
-    gaze_right = get_gaze(face, 471, 469, 33, 133)
-    return round((gaze_left + gaze_right) / 2, 1)
-
-def get_gaze(face, iris_L_side, iris_R_side, eye_L_corner, eye_R_corner):
-    iris = (face[iris_L_side].x + face[iris_R_side].x, face[iris_L_side].y + face[iris_R_side].y)
-    eye_center = (face[eye_L_corner].x + face[eye_R_corner].x, face[eye_L_corner].y + face[eye_R_corner].y)
-    gaze_dist = dist.euclidean(iris, eye_center)
-    eye_width = abs(face[eye_R_corner].x - face[eye_L_corner].x)
-    gaze_relative = gaze_dist / eye_width
-    if (eye_center[0] - iris[0]) < 0:
-        gaze_relative *= -1
-    return gaze_relative
-
-def detect_gaze_change(avg_gaze):
-    global gaze_values
-    gaze_values = gaze_values[1:] + [avg_gaze]
+    return float(landmarks.get_avg_gaze(face))
+
+def detect_gaze_change(gaze_values, avg_gaze):
+    gaze_values.append(avg_gaze)
     gaze_relative_matches = 1.0 * gaze_values.count(avg_gaze) / MAX_FRAMES
     if gaze_relative_matches < .01:
         return gaze_relative_matches
     return 0
 
-def get_lip_ratio(face):
-    return get_aspect_ratio(face[0], face[17], face[61], face[291])
-
-def get_mood(image):
-    global emotion_detector, calculating_mood, mood
-    detected_mood, score = emotion_detector.top_emotion(image)
-    calculating_mood = False
-    if score and (score > .4 or detected_mood == 'neutral'):
-        mood = detected_mood
-        return mood
+def hold(window, value, frames=1):
+    # sample-and-hold over the frames skipped since the previous sample
+    for _ in range(frames):
+        window.append(value)
 
 def get_emotions(image):
-    global emotion_detector
     emotion_data = {
         "angry": 0,
         "disgust": 0,
@@ -197,73 +143,179 @@ def get_emotions(image):
         "surprise": 0,
         "neutral": 0
     }
-    emotions = emotion_detector.detect_emotions(image)
+    with emotion_lock:
+        emotions = get_emotion_detector().detect_emotions(image)
     if emotions:
         for emotion in emotions:
             for key in emotion["emotions"]:
                 emotion_data[key] += emotion["emotions"][key]
     return emotion_data
 
-def get_face_relative_area(face):
-    face_width = abs(max(face[454].x, 0) - max(face[234].x, 0))
-    face_height = abs(max(face[152].y, 0) - max(face[10].y, 0))
-    return face_width * face_height
-
 def find_face_and_hands(image_original, face_mesh, hands):
-    image = image_original.copy()
+    image = cv2.cvtColor(image_original, cv2.COLOR_BGR2RGB)
     image.flags.writeable = False
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    faces = face_mesh.process(image)
-    hands_landmarks = hands.process(image).multi_hand_landmarks
+    with span('facemesh'):
+        faces = face_mesh.process(image)
+    with span('hands'):
+        hands_landmarks = hands.process(image).multi_hand_landmarks
     face_landmarks = None
     if faces.multi_face_landmarks and len(faces.multi_face_landmarks) > 0:
         face_landmarks = faces.multi_face_landmarks[0]
-    return face_landmarks, hands_landmarks
-
-def process_frame(image, face_landmarks, hands_landmarks, calibrated=False, fps=None, ttl_for_tells=30):
-    global tells, calculating_mood
-    global blinks, hand_on_face, face_area_size
-    tells = decrement_tells(tells)
-    if face_landmarks:
-        face = face_landmarks.landmark
-        face_area_size = get_face_relative_area(face)
-        if not calculating_mood:
-            emothread = threading.Thread(target=get_mood, args=(image,))
-            emothread.start()
-            calculating_mood = True
-        cheekL = get_area(image, False, topL=face[449], topR=face[350], bottomR=face[429], bottomL=face[280])
-        cheekR = get_area(image, False, topL=face[121], topR=face[229], bottomR=face[50], bottomL=face[209])
-        bpm = get_bpm_change_value(image, False, face_landmarks, hands_landmarks, fps)
-        bpm_display = f"BPM: {bpm:.2f}" if bpm else "BPM: ..."
-        tells['avg_bpms'] = new_tell(bpm_display, ttl_for_tells)
-        if bpm:
-            bpm_delta = bpm - avg_bpms[-1]
-            if abs(bpm_delta) > SIGNIFICANT_BPM_CHANGE:
-                change_desc = "Heart rate increasing" if bpm_delta > 0 else "Heart rate decreasing"
-                tells['bpm_change'] = new_tell(change_desc, ttl_for_tells)
-        blinks = blinks[1:] + [is_blinking(face)]
-        recent_blink_tell = get_blink_tell(blinks)
-        if recent_blink_tell:
-            tells['blinking'] = new_tell(recent_blink_tell, ttl_for_tells)
-        recent_hand_on_face = check_hand_on_face(hands_landmarks, face)
-        hand_on_face = hand_on_face[1:] + [recent_hand_on_face]
-        if recent_hand_on_face:
-            tells['hand'] = new_tell("Hand covering face", ttl_for_tells)
-        avg_gaze = get_avg_gaze(face)
-        if detect_gaze_change(avg_gaze):
-            tells['gaze'] = new_tell("Change in gaze", ttl_for_tells)
-        if get_lip_ratio(face) < LIP_COMPRESSION_RATIO:
-            tells['lips'] = new_tell("Lip compression", ttl_for_tells)
-    return tells
+    return face_to_array(face_landmarks), hands_to_array(hands_landmarks)
+
+class DetectorSession:
+    # All per-subject state: signal windows, active tells, mood and the MediaPipe graphs
+    # (which track between frames). Graphs not passed in come from the model pool and go
+    # back to it on close(); the emotion detector is shared between sessions. With
+    # frame_clock_mood, mood is classified inline at video-time intervals, so a file gives
+    # the same moods on every run.
+    def __init__(self, detector=None, face_mesh=None, hands=None, max_frames=MAX_FRAMES, recent_frames=RECENT_FRAMES, mood_rate=MOOD_RATE, roi=False, keyframe_interval=1, frame_clock_mood=False):
+        self.emotion_detector = detector  # None for the shared one
+        self.face_roi = FaceRoi() if roi else None
+        self.tracker = LandmarkTracker(keyframe_interval) if keyframe_interval > 1 else None
+        self.mood_rate = mood_rate
+        self.frame_clock_mood = frame_clock_mood
+        self.emotion_worker = None
+        self.face_mesh = face_mesh
+        self.hands = hands
+        self.roi_face_mesh = None
+        self.roi_hands = None
+        self.pooled = []  # graph pairs to hand back to the pool
+        self.tells = dict()
+        self.blinks = RingBuffer(max_frames, False, dtype=bool, edge=recent_frames)
+        self.hand_on_face = RingBuffer(max_frames, False, dtype=bool)
+        self.face_area_size = 0
+        self.heart_rate = HeartRateMonitor()
+        self.cheeks = CheekSampler()
+        self.frame_count = 0
+        self.gaze_values = RingBuffer(max_frames, 0, counts=True)
+        self.bpm = None
+        self.last_timestamp = None
+
+    @property
+    def mood(self):
+        return self.emotion_worker.latest()[0] if self.emotion_worker else ''
+
+    def acquire_models(self):
+        models = model_pool.acquire()
+        self.pooled.append(models)
+        return models
+
+    def models(self):
+        if self.face_mesh is None or self.hands is None:
+            face_mesh, hands = self.acquire_models()
+            self.face_mesh = self.face_mesh or face_mesh
+            self.hands = self.hands or hands
+        return self.face_mesh, self.hands
+
+    def roi_models(self):
+        if self.roi_face_mesh is None:
+            self.roi_face_mesh, self.roi_hands = self.acquire_models()
+        return self.roi_face_mesh, self.roi_hands
+
+    def find_face_and_hands(self, image):
+        with span('find_face_and_hands'):
+            if self.tracker:
+                return self.tracker.find_face_and_hands(image, self.infer_face_and_hands)
+            return self.infer_face_and_hands(image)
+
+    def infer_face_and_hands(self, image):
+        if self.face_roi:
+            return self.face_roi.find_face_and_hands(
+                image,
+                lambda frame: find_face_and_hands(frame, *self.models()),
+                lambda crop: find_face_and_hands(crop, *self.roi_models()))
+        return find_face_and_hands(image, *self.models())
+
+    def close(self):
+        # graphs passed in are left to the caller, e.g. to close in a with block
+        for models in self.pooled:
+            model_pool.release(models)
+        self.pooled = []
+        self.face_mesh = self.hands = self.roi_face_mesh = self.roi_hands = None
+        if self.emotion_worker:
+            self.emotion_worker.close()
+            self.emotion_worker = None
+
+    def update_mood(self, image, face, timestamp=None):
+        if not self.mood_rate:  # mood disabled, FER is never loaded
+            return
+        if self.emotion_worker is None:
+            worker = FrameClockEmotion if self.frame_clock_mood else EmotionWorker
+            self.emotion_worker = worker(self.emotion_detector, self.mood_rate, emotion_lock, load=get_emotion_detector)
+        if self.emotion_worker.due(timestamp):
+            crop, face_rect = crop_face(image, face)
+            if crop is not None:
+                self.emotion_worker.submit(crop, face_rect, timestamp)
+
+    def elapsed_frames(self, timestamp, fps):
+        # how many frame periods this frame stands for, so that frame-counted windows
+        # keep covering the same stretch of time when a live source skips frames
+        last, self.last_timestamp = self.last_timestamp, timestamp
+        if timestamp is None or last is None or not fps:
+            return 1
+        return int(min(max(round((timestamp - last) * fps), 1), len(self.blinks)))
+
+    def clock(self, timestamp, fps):
+        # seconds for the heart rate signal: the capture time when known, else frames at fps
+        self.frame_count += 1
+        if timestamp is not None:
+            return timestamp
+        return self.frame_count / fps if fps else time.time()
+
+    def get_bpm_change_value(self, image, draw, face_landmarks, hands_landmarks, seconds):
+        if face_landmarks is not None:
+            color = self.cheeks.sample(image, face_landmarks)
+            if color is not None:
+                self.heart_rate.add(seconds, color)
+        return self.heart_rate.bpm
+
+    def process_frame(self, image, face_landmarks, hands_landmarks, calibrated=False, fps=None, ttl_for_tells=30, timestamp=None):
+        # timestamp: capture time of a live frame, or None to count time in frames at `fps`
+        with span('process_frame'):
+            return self.find_tells(image, face_landmarks, hands_landmarks, fps, ttl_for_tells, timestamp)
+
+    def find_tells(self, image, face_landmarks, hands_landmarks, fps, ttl_for_tells, timestamp):
+        frames = self.elapsed_frames(timestamp, fps)
+        seconds = self.clock(timestamp, fps)
+        tells = decrement_tells(self.tells, frames)
+        if face_landmarks is not None:
+            face = face_landmarks
+            self.face_area_size = get_face_relative_area(face)
+            self.update_mood(image, face, seconds)
+            with span('tell.bpm'):
+                bpm = self.bpm = self.get_bpm_change_value(image, False, face_landmarks, hands_landmarks, seconds)
+                bpm_display = f"BPM: {bpm:.2f}" if bpm else "BPM: ..."
+                tells['avg_bpms'] = new_tell(bpm_display, ttl_for_tells)
+                if bpm:
+                    bpm_delta = self.heart_rate.change()
+                    if abs(bpm_delta) > SIGNIFICANT_BPM_CHANGE:
+                        change_desc = "Heart rate increasing" if bpm_delta > 0 else "Heart rate decreasing"
+                        tells['bpm_change'] = new_tell(change_desc, ttl_for_tells)
+            with span('tell.blinking'):
+                hold(self.blinks, is_blinking(face), frames)
+                recent_blink_tell = get_blink_tell(self.blinks)
+                if recent_blink_tell:
+                    tells['blinking'] = new_tell(recent_blink_tell, ttl_for_tells)
+            with span('tell.hand'):
+                recent_hand_on_face = check_hand_on_face(hands_landmarks, face)
+                hold(self.hand_on_face, recent_hand_on_face, frames)
+                if recent_hand_on_face:
+                    tells['hand'] = new_tell("Hand covering face", ttl_for_tells)
+            with span('tell.gaze'):
+                avg_gaze = get_avg_gaze(face)
+                if detect_gaze_change(self.gaze_values, avg_gaze):
+                    tells['gaze'] = new_tell("Change in gaze", ttl_for_tells)
+            with span('tell.lips'):
+                if get_lip_ratio(face) < LIP_COMPRESSION_RATIO:
+                    tells['lips'] = new_tell("Lip compression", ttl_for_tells)
+        return tells
+
+default_session = None
 
-def get_bpm_change_value(image, draw, face_landmarks, hands_landmarks, fps):
-    if face_landmarks:
-        face = face_landmarks.landmark
-        cheekL = get_area(image, draw, topL=face[449], topR=face[350], bottomR=face[429], bottomL=face[280])
-        cheekR = get_area(image, draw, topL=face[121], topR=face[229], bottomR=face[50], bottomL=face[209])
-        global hr_values
-        cheekLwithoutBlue = np.average(cheekL[:, :, 1:3])
-        cheekRwithoutBlue = np.average(cheekR[:, :, 1:3])
-        hr_values = hr_values[1:] + [cheekLwithoutBlue + cheekRwithoutBlue]
-    bpm = calculate_bpm(hr_values, fps)
-    return bpm
+def process_frame(image, face_landmarks, hands_landmarks, calibrated=False, fps=None, ttl_for_tells=30, timestamp=None):
+    # single-subject shortcut; create a DetectorSession per subject to analyze several at once
+    global default_session
+    if default_session is None:
+        default_session = DetectorSession()
+    return default_session.process_frame(image, face_landmarks, hands_landmarks, calibrated, fps, ttl_for_tells, timestamp)
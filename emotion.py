@@ -0,0 +1,174 @@
+import math
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from landmarks import FACEMESH_FACE_OVAL
+from tracing import span
+
+MOOD_RATE = 3  # mood estimates per second
+MOOD_MIN_SCORE = .4
+FACE_MARGIN = .25  # context kept around the face oval, relative to its size
+FACE_SIZE = 128  # face width in pixels handed to FER, which classifies 64x64 faces
+
+load_failed = False
+
+
+def face_box(face, width, height):
+    points = np.asarray(face)[FACEMESH_FACE_OVAL, :2] * (width, height)
+    x1, y1 = np.floor(points.min(axis=0)).astype(int)
+    x2, y2 = np.ceil(points.max(axis=0)).astype(int)
+    return max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+
+
+def crop_face(image, face):
+    # crop (and downscale) the FaceMesh face so FER only runs its classifier;
+    # returns the crop and the face rectangle (x, y, w, h) inside it
+    height, width = image.shape[:2]
+    x1, y1, x2, y2 = face_box(face, width, height)
+    if x2 <= x1 or y2 <= y1:
+        return None, None
+    margin_x, margin_y = int((x2 - x1) * FACE_MARGIN), int((y2 - y1) * FACE_MARGIN)
+    left, top = max(x1 - margin_x, 0), max(y1 - margin_y, 0)
+    right, bottom = min(x2 + margin_x, width), min(y2 + margin_y, height)
+    crop = image[top:bottom, left:right]
+    scale = min(1.0, FACE_SIZE / (x2 - x1))
+    if scale < 1:
+        crop = cv2.resize(crop, (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+    else:
+        crop = crop.copy()
+    rect = (int((x1 - left) * scale), int((y1 - top) * scale), int((x2 - x1) * scale), int((y2 - y1) * scale))
+    return crop, rect
+
+
+def classify(detector, image, face_rect=None):
+    # (mood, score) of the face in image; with face_rect (x, y, w, h) FER skips its own face detection
+    if face_rect is None:
+        return detector.top_emotion(image)
+    emotions = detector.detect_emotions(image, face_rectangles=[face_rect])
+    if not emotions:
+        return None, None
+    return max(emotions[0]['emotions'].items(), key=lambda item: item[1])
+
+
+def load_detector(load):
+    # the detector, or None when it cannot be loaded (e.g. fer is not installed); the
+    # reason is printed for the first failure only, as every session would repeat it
+    global load_failed
+    try:
+        return load()
+    except Exception as error:
+        if not load_failed:
+            load_failed = True
+            print("Mood detection disabled, the emotion model could not be loaded: {!r}".format(error), file=sys.stderr)
+        return None
+
+
+def accepted(mood, score):
+    return bool(score) and (score > MOOD_MIN_SCORE or mood == 'neutral')
+
+
+class EmotionWorker:
+    # A single long-lived thread classifying mood at most `rate` times per second.
+    # Frames go through a one-slot mailbox, so only the most recent one is classified.
+    # Without a detector, `load` is called on the worker thread to get one, so a slow
+    # model load never holds up the caller. If loading fails the worker stops, and the
+    # session goes on without mood.
+    def __init__(self, detector, rate=MOOD_RATE, detector_lock=None, load=None):
+        self.detector = detector
+        self.load = load
+        self.interval = 1.0 / rate
+        self.detector_lock = detector_lock or threading.Lock()
+        self.condition = threading.Condition()
+        self.result_lock = threading.Lock()
+        self.pending = None
+        self.next_time = 0
+        self.running = True
+        self.disabled = False
+        self.mood = ''
+        self.score = None
+        self.timestamp = None  # capture time of the frame the current mood came from
+        self.thread = threading.Thread(target=self.run, name='emotion', daemon=True)
+        self.thread.start()
+
+    def due(self, timestamp=None):
+        # lets callers skip copying frames the worker would not classify anyway
+        return not self.disabled and self.pending is None and time.monotonic() >= self.next_time
+
+    def submit(self, image, face_rect=None, timestamp=None):
+        # with face_rect (x, y, w, h) FER skips its own face detection
+        with self.condition:
+            self.pending = (image, face_rect, timestamp if timestamp is not None else time.time())
+            self.condition.notify()
+
+    def latest(self):
+        with self.result_lock:
+            return self.mood, self.score, self.timestamp
+
+    def run(self):
+        if self.detector is None:
+            self.detector = load_detector(self.load)
+            if self.detector is None:
+                self.disabled = True
+                return
+        while True:
+            with self.condition:
+                while self.running and (self.pending is None or time.monotonic() < self.next_time):
+                    self.condition.wait(None if self.pending is None else self.next_time - time.monotonic())
+                if not self.running:
+                    return
+                image, face_rect, timestamp = self.pending
+                self.pending = None
+                self.next_time = time.monotonic() + self.interval
+            with self.detector_lock, span('mood'):
+                detected_mood, score = classify(self.detector, image, face_rect)
+            if accepted(detected_mood, score):
+                with self.result_lock:
+                    self.mood, self.score, self.timestamp = detected_mood, score, timestamp
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=1)
+
+
+class FrameClockEmotion:
+    # Classifies mood on the calling thread, on the first frame of every 1 / rate seconds of
+    # video time. Unlike the wall-clock EmotionWorker, which classifies whichever frame is
+    # current when it is free, this picks the same frames on every run and on any machine,
+    # so analyzing a file always gives the same moods.
+    def __init__(self, detector, rate=MOOD_RATE, detector_lock=None, load=None):
+        self.detector = detector
+        self.load = load
+        self.interval = 1.0 / rate
+        self.detector_lock = detector_lock or threading.Lock()
+        self.slot = None  # interval of the last classified frame
+        self.disabled = False
+        self.mood = ''
+        self.score = None
+        self.timestamp = None
+
+    def due(self, timestamp=None):
+        return not self.disabled and timestamp is not None and (self.slot is None or math.floor(timestamp / self.interval + 1e-6) > self.slot)
+
+    def submit(self, image, face_rect=None, timestamp=None):
+        self.slot = math.floor(timestamp / self.interval + 1e-6)
+        if self.detector is None:
+            self.detector = load_detector(self.load)
+            if self.detector is None:
+                self.disabled = True
+                return
+        with self.detector_lock, span('mood'):
+            detected_mood, score = classify(self.detector, image, face_rect)
+        if accepted(detected_mood, score):
+            self.mood, self.score, self.timestamp = detected_mood, score, timestamp
+
+    def latest(self):
+        return self.mood, self.score, self.timestamp
+
+    def close(self):
+        pass
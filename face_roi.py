@@ -0,0 +1,66 @@
+import numpy as np
+
+ROI_SCALE = 2.0  # crop side relative to the face, leaving room for hands touching it
+ROI_MARGIN = .15  # how close the face may get to the crop border before the crop moves
+
+
+def face_bounds(face, width, height):
+    points = face[:, :2] * (width, height)
+    (x1, y1), (x2, y2) = points.min(axis=0), points.max(axis=0)
+    return x1, y1, x2, y2
+
+
+def to_full_frame(points, box, width, height):
+    # normalized crop coordinates -> normalized full-frame coordinates (z scales like x)
+    if points is None:
+        return None
+    left, top, right, bottom = box
+    scale = np.array([(right - left) / width, (bottom - top) / height, (right - left) / width], dtype=np.float32)
+    offset = np.array([left / width, top / height, 0], dtype=np.float32)
+    return points * scale + offset
+
+
+class FaceRoi:
+    # Runs inference on an expanded box around the previous frame's face instead of the
+    # whole frame, falling back to the full frame when the face is lost. Crops and full
+    # frames need separate MediaPipe graphs, since each graph tracks landmarks in the
+    # coordinates of the images it was last given.
+    def __init__(self, scale=ROI_SCALE, margin=ROI_MARGIN):
+        self.scale = scale
+        self.margin = margin
+        self.box = None  # (left, top, right, bottom) in pixels
+
+    def reset(self):
+        self.box = None
+
+    def find_face_and_hands(self, image, find, find_crop):
+        # find(image) and find_crop(crop) -> (face, hands) normalized to the image they were given
+        height, width = image.shape[:2]
+        face = hands = None
+        if self.box is not None:
+            left, top, right, bottom = self.box
+            face, hands = find_crop(image[top:bottom, left:right])
+            face = to_full_frame(face, self.box, width, height)
+            hands = to_full_frame(hands, self.box, width, height)
+        if face is None:
+            face, hands = find(image)
+        self.update(face, width, height)
+        return face, hands
+
+    def update(self, face, width, height):
+        if face is None:
+            self.box = None
+            return
+        x1, y1, x2, y2 = face_bounds(face, width, height)
+        if self.box is not None:
+            left, top, right, bottom = self.box
+            margin = self.margin * (right - left)
+            size = max(x2 - x1, y2 - y1) * self.scale
+            inside = x1 - left > margin and right - x2 > margin and y1 - top > margin and bottom - y2 > margin
+            if inside and .8 < size / max(right - left, bottom - top) < 1.25:
+                return  # a steady crop lets FaceMesh keep tracking between frames
+        side = max(x2 - x1, y2 - y1) * self.scale
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        left, top = int(max(cx - side / 2, 0)), int(max(cy - side / 2, 0))
+        right, bottom = int(min(cx + side / 2, width)), int(min(cy + side / 2, height))
+        self.box = (left, top, right, bottom) if right > left and bottom > top else None
@@ -0,0 +1,111 @@
+import math
+
+import numpy as np
+from scipy.signal import butter, filtfilt, welch
+
+from ring_buffer import RingBuffer
+
+SAMPLE_RATE = 30  # Hz of the resampled signal
+WINDOW_SECONDS = 10
+MIN_SECONDS = 5  # signal needed before the first estimate
+UPDATE_INTERVAL = 1.0  # seconds between spectral estimates
+SEGMENT_SECONDS = 8  # Welch segment length
+NFFT = 2048  # zero padding, ~.9 BPM bins at 30 Hz
+MIN_BPM = 50
+MAX_BPM = 150
+MAX_GAP = 1.0  # seconds without samples (e.g. face lost) before the window restarts
+HISTORY = 30  # estimates kept to tell a change from the usual rate, from at most as many update intervals back
+
+
+class HeartRateMonitor:
+    # Remote photoplethysmography from the mean cheek colour. Samples arrive at irregular
+    # times and are linearly interpolated onto a fixed-rate grid as they come in, so a frame
+    # costs a few appends. Every `update_interval` seconds the window is turned into a pulse
+    # signal with the chrominance (CHROM) method, band-passed, and the heart rate is read off
+    # the strongest frequency of its Welch spectrum. The grid and the update times are
+    # multiples of their period, so the estimates do not depend on when monitoring started
+    # once the window and history have filled.
+    def __init__(self, rate=SAMPLE_RATE, window_seconds=WINDOW_SECONDS, update_interval=UPDATE_INTERVAL, min_bpm=MIN_BPM, max_bpm=MAX_BPM):
+        self.rate = rate
+        self.size = int(window_seconds * rate)
+        self.min_samples = int(MIN_SECONDS * rate)
+        self.segment = int(SEGMENT_SECONDS * rate)
+        self.update_interval = update_interval
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.filter = butter(3, [min_bpm / 60, max_bpm / 60], btype='band', fs=rate)
+        self.channels = [RingBuffer(self.size) for _ in range(3)]  # B, G, R
+        self.buffer = np.empty((3, self.size))
+        self.history = RingBuffer(HISTORY, np.nan)
+        self.history_times = RingBuffer(HISTORY, -np.inf)
+        self.samples = 0  # grid points since the window (re)started
+        self.last_time = None
+        self.last_color = None
+        self.grid = None  # index of the next grid point, at grid / rate seconds
+        self.next_update = None
+        self.pulse = None  # band-passed pulse signal of the last estimate
+        self.bpm = None
+
+    def reset(self):
+        self.samples = 0
+        self.last_time = None
+        self.pulse = None
+        self.bpm = None
+
+    def add(self, timestamp, color):
+        # color: mean (B, G, R) of the skin, timestamp in seconds; returns the current estimate
+        color = np.asarray(color, dtype=np.float64)
+        if self.last_time is not None and timestamp <= self.last_time:
+            return self.bpm
+        if self.last_time is None or timestamp - self.last_time > MAX_GAP:
+            self.reset()
+            self.grid = math.ceil(timestamp * self.rate - 1e-6)
+            self.next_update = timestamp
+        else:
+            while self.grid / self.rate <= timestamp:
+                fraction = (self.grid / self.rate - self.last_time) / (timestamp - self.last_time)
+                for channel, value in zip(self.channels, self.last_color + fraction * (color - self.last_color)):
+                    channel.append(value)
+                self.samples += 1
+                self.grid += 1
+        self.last_time, self.last_color = timestamp, color
+        if timestamp >= self.next_update:
+            self.next_update = (math.floor(timestamp / self.update_interval + 1e-6) + 1) * self.update_interval
+            self.update(timestamp)
+        return self.bpm
+
+    def window(self):
+        # (times, colors) of the resampled signal, oldest first; colors has shape (3, n)
+        count = min(self.samples, self.size)
+        for channel, out in zip(self.channels, self.buffer):
+            channel.values(out)
+        times = (self.grid - np.arange(count, 0, -1)) / self.rate if count else np.empty(0)
+        return times, self.buffer[:, self.size - count:]
+
+    def update(self, timestamp):
+        _, colors = self.window()
+        if colors.shape[1] < self.min_samples or not (colors.mean(axis=1) > 0).all():
+            self.bpm = None
+            self.pulse = None
+            return
+        blue, green, red = colors / colors.mean(axis=1, keepdims=True)  # independent of skin tone and lighting
+        x = filtfilt(*self.filter, 3 * red - 2 * green)
+        y = filtfilt(*self.filter, 1.5 * red + green - 1.5 * blue)
+        pulse = x - x.std() / (y.std() or 1) * y  # cancels the specular (motion) component
+        self.pulse = pulse
+        freqs, power = welch(pulse, fs=self.rate, nperseg=min(len(pulse), self.segment), nfft=NFFT)
+        band = (freqs >= self.min_bpm / 60) & (freqs <= self.max_bpm / 60)
+        self.bpm = float(freqs[band][np.argmax(power[band])] * 60)
+        self.history.append(self.bpm)
+        self.history_times.append(timestamp)
+
+    def change(self):
+        # latest estimate minus the average of the earlier ones. Only estimates from the last
+        # HISTORY update intervals count: after the face was lost the buffer would otherwise
+        # reach back arbitrarily far, and a chunk's warm-up could not reproduce it.
+        times = self.history_times.values()
+        estimates = self.history.values()
+        estimates = estimates[np.isfinite(estimates) & (times > times[-1] - HISTORY * self.update_interval)]
+        if len(estimates) < 3:
+            return 0
+        return estimates[-1] - estimates[:-1].mean()
@@ -2,21 +2,24 @@ import argparse
 
 import cv2
 import mediapipe as mp
-from ffpyplayer.player import MediaPlayer
 
 from datetime import datetime
-from matplotlib import pyplot as plt
-import mss
-import numpy as np
-from scipy.signal import find_peaks
-from scipy.spatial import distance as dist
 
-from fer import FER
-
-import threading
 import time
 import sys
 
+from pipeline import FramePipeline, LatencyController, StreamScheduler, END_OF_STREAM
+from deception_detection import DetectorSession, hold
+from cheek_sampler import cheek_rects
+from screen_capture import ScreenSource
+from recorder import Recorder
+from bpm_chart import BpmChart
+import tracing
+from tracing import span
+import emotion
+import landmarks
+from landmarks import to_landmark_list, get_lip_ratio, get_face_relative_area
+
 
 MAX_FRAMES = 120 # modify this to affect calibration period and amount of "lookback"
 RECENT_FRAMES = int(MAX_FRAMES / 10) # modify to affect sensitivity to recent changes
@@ -37,54 +40,19 @@ EPOCH = time.time()
 
 
 recording = None
+raw_recording = None
 
-tells = dict()
-
-blinks = [False] * MAX_FRAMES
-blinks2 = [False] * MAX_FRAMES # for mirroring
-
-hand_on_face = [False] * MAX_FRAMES
-hand_on_face2 = [False] * MAX_FRAMES # for mirroring
-
-face_area_size = 0 # relative size of face to total frame
-
-hr_times = list(range(0, MAX_FRAMES))
-hr_values = [400] * MAX_FRAMES
-avg_bpms = [0] * MAX_FRAMES
-
-gaze_values = [0] * MAX_FRAMES
-
-emotion_detector = FER(mtcnn=True)
-calculating_mood = False
-mood = ''
-
-meter = cv2.imread('meter.png')
+meter = None # truth meter image, loaded with the first frame
 
-# BPM chart
-fig = None
-ax = None
-line = None
-peakpts = None
+chart = None # BPM chart
 
-def chart_setup():
-  global fig, ax, line, peakpts
 
-  plt.ion()
-  fig = plt.figure()
-  ax = fig.add_subplot(1,1,1) # 1st 1x1 subplot
-  ax.set(ylim=(185, 200))
-
-  line, = ax.plot(hr_times, hr_values, 'b-')
-  peakpts, = ax.plot([], [], 'r+')
-
-
-
-def decrement_tells(tells):  #indications of stress
+def decrement_tells(tells, frames=1):  #indications of stress
   # Each tell has a time to live that determines how long
   # it should be displayed to the user
   for key, tell in tells.copy().items():
     if 'ttl' in tell:
-      tell['ttl'] -= 1
+      tell['ttl'] -= frames
       if tell['ttl'] <= 0:
         del tells[key]
   return tells
@@ -92,7 +60,7 @@ def decrement_tells(tells):  #indications of stress
 
 def main():
   global TELL_MAX_TTL
-  global recording
+  global chart
 
   parser = argparse.ArgumentParser()
   parser.add_argument('--input', '-i', nargs='*', help='Input video device (number or path), file, or screen dimensions (x y width height), defaults to 0', default=['0'])
@@ -101,7 +69,13 @@ def main():
   parser.add_argument('--flip', '-f', help='Set to any value to flip resulting output (selfie view)')
   parser.add_argument('--ttl', '-t', help='How many frames for each displayed "tell" to last, defaults to 30', default='30')
   parser.add_argument('--record', '-r', help='Set to any value to save a timestamped AVI in current directory')
+  parser.add_argument('--raw', '-w', help='Set to any value to also save the unannotated input as a timestamped AVI')
   parser.add_argument('--second', '-s', help='Secondary video input device (number or path)')
+  parser.add_argument('--roi', '-c', help='Set to any value to run face and hand detection only on a crop around the tracked face')
+  parser.add_argument('--keyframes', '-k', help='Run face and hand detection every N frames and track landmarks with optical flow in between, defaults to 1 (every frame)', default='1')
+  parser.add_argument('--latency', '-d', help='Latency budget in milliseconds for live inputs; frames are skipped to stay within it, defaults to 150', default='150')
+  parser.add_argument('--nomood', '-m', help='Set to any value to skip mood detection, which also skips loading TensorFlow')
+  parser.add_argument('--trace', '-p', help='Path of a Chrome/Perfetto trace file of timed spans to write on exit; also draws rolling timings on the output')
   args = parser.parse_args()
 
   if len(args.input) == 1:
@@ -115,12 +89,17 @@ def main():
   if args.ttl and args.ttl.isdigit():
     TELL_MAX_TTL = int(args.ttl)
   RECORD = args.record is not None
+  RECORD_RAW = args.raw is not None
+  RECORDING_FILENAME = str(datetime.now()).replace('.','').replace(':','')
+  ROI = args.roi is not None
+  MOOD_RATE = 0 if args.nomood is not None else emotion.MOOD_RATE
+  KEYFRAMES = int(args.keyframes) if args.keyframes.isdigit() else 1
+  LATENCY_BUDGET = int(args.latency) / 1000 if args.latency.isdigit() else .15
+  if args.trace:
+    tracing.enable(args.trace)
 
   SECOND = int(args.second) if (args.second or "").isdigit() else args.second
 
-  if BPM_CHART:
-    chart_setup()
-
   if SECOND:
     cap2 = cv2.VideoCapture(SECOND)
 
@@ -134,6 +113,75 @@ def main():
     with mp.solutions.hands.Hands(
         max_num_hands=2,
         min_detection_confidence=0.7) as hands:
+      session = DetectorSession(face_mesh=face_mesh, hands=hands, max_frames=MAX_FRAMES, recent_frames=RECENT_FRAMES, mood_rate=MOOD_RATE, roi=ROI, keyframe_interval=KEYFRAMES)
+      mirror_session = DetectorSession(max_frames=MAX_FRAMES, recent_frames=RECENT_FRAMES, mood_rate=MOOD_RATE, roi=ROI, keyframe_interval=KEYFRAMES) # own models, tracking state is per stream
+      if BPM_CHART:
+        chart = BpmChart()
+
+      def analyze(image, fps=None, timestamp=None):
+        if raw_recording:
+          raw_recording.write(image, timestamp) # copied before any drawing
+        with span('process_frame'):
+          found = process(session, image, calibrated, DRAW_LANDMARKS, BPM_CHART, FLIP, fps, timestamp)
+        return image, found, mirror_stats(session)
+
+      def show(pipeline, fps=None, source=None):
+        global recording, raw_recording
+        nonlocal calibrated, calibration_frames
+        # encoded on background threads, at fps or the measured display rate
+        if RECORD:
+          recording = Recorder(RECORDING_FILENAME + '.avi', fps)
+        if RECORD_RAW:
+          raw_recording = Recorder(RECORDING_FILENAME + '_raw.avi', fps)
+        mirror = None
+        if SECOND: # both inputs run side by side on a shared worker pool, the displayed one first
+          capture_fps2 = cap2.get(cv2.CAP_PROP_FPS)
+          mirror = FramePipeline(cap2.read, lambda image, timestamp: process_second(mirror_session, image, capture_fps2, timestamp), live=True)
+          streams = StreamScheduler()
+          streams.add(pipeline, priority=2)
+          streams.add(mirror)
+          streams.start()
+        else:
+          streams = pipeline.start()
+        try:
+          while True:
+            result = pipeline.get(timeout=.1)
+            if result is END_OF_STREAM:
+              break
+            if result is not None:
+              started = time.time()
+              image, found, stats = result
+              if mirror:
+                mirrored = mirror.nearest(pipeline.timestamp) # captured at about the same time
+                if mirrored is not None:
+                  write_mirror_comparisons(image, stats, mirrored)
+              calibration_frames += found
+              calibrated = (calibration_frames >= MAX_FRAMES)
+              if tracing.enabled:
+                add_span_stats(image)
+              with span('render'):
+                cv2.imshow('face', image)
+              if RECORD:
+                recording.write(image, pipeline.timestamp if pipeline.live else None)
+              if pipeline.controller:
+                pipeline.controller.record('render', time.time() - started)
+            if chart: # redrawn at its own rate, only when new data came in
+              chart_image = chart.render()
+              if chart_image is not None:
+                cv2.imshow('bpm', chart_image)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+              break
+        finally: # the sessions' graphs go back to the pool and their emotion workers stop
+          streams.stop()
+          session.close()
+          mirror_session.close()
+          if source:
+            source.close()
+        for recorder in (recording, raw_recording):
+          if recorder:
+            recorder.close()
+            print("Recorded {} frames to {} ({} dropped)".format(recorder.written, recorder.path, recorder.dropped))
+
       if len(args.input) == 4:
         screen = {
           "top": int(args.input[0]),
@@ -141,24 +189,16 @@ def main():
           "width": int(args.input[2]),
           "height": int(args.input[3])
         }
-        with mss.mss() as sct: # screenshot
-          while True:
-            image = np.array(sct.grab(screen))[:, :, :3] # remove alpha channel
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            calibration_frames += process(image, face_mesh, hands, calibrated, DRAW_LANDMARKS, BPM_CHART, FLIP)
-            calibrated = (calibration_frames >= MAX_FRAMES)
-            if SECOND:
-              process_second(cap2, image, face_mesh, hands)
-            cv2.imshow('face', image)
-            if RECORD:
-              recording.write(image)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-              break
+        source = ScreenSource(screen) # unchanged frames are skipped before inference
+        # frames dropped as duplicates or over the latency budget still count as elapsed frames
+        show(FramePipeline(source.read, lambda image, timestamp: analyze(image, source.fps, timestamp), live=True, controller=LatencyController(LATENCY_BUDGET)), source=source)
       else:
         cap = cv2.VideoCapture(INPUT)
         fps = None
+        live = True
         if isinstance(INPUT, str) and INPUT.find('.') > -1: # from file
           fps = cap.get(cv2.CAP_PROP_FPS)
+          live = False
           print("FPS:", fps)
           # cap.set(cv2.CAP_PROP_BUFFERSIZE, 10)
         else: # from device
@@ -166,31 +206,15 @@ def main():
           cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
           cap.set(cv2.CAP_PROP_FPS, 30)
 
-        if RECORD:
-          RECORDING_FILENAME = str(datetime.now()).replace('.','').replace(':','') + '.avi'
-          FPS_OUT = 10
-          FRAME_SIZE = (int(cap.get(3)), int(cap.get(4)))
-          recording = cv2.VideoWriter(
-            RECORDING_FILENAME, cv2.VideoWriter_fourcc(*'MJPG'), FPS_OUT, FRAME_SIZE)
-
-        while cap.isOpened():
-          success, image = cap.read()
-          if not success: break
-          calibration_frames += process(image, face_mesh, hands, calibrated, DRAW_LANDMARKS, BPM_CHART, FLIP, fps)
-          calibrated = (calibration_frames >= MAX_FRAMES)
-          if SECOND:
-            process_second(cap2, image, face_mesh, hands)
-          cv2.imshow('face', image)
-          if RECORD:
-            recording.write(image)
-          if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+        if live: # frames carry their capture time, fps only converts skipped time into frames
+          capture_fps = cap.get(cv2.CAP_PROP_FPS)
+          show(FramePipeline(cap.read, lambda image, timestamp: analyze(image, capture_fps, timestamp), live=True, controller=LatencyController(LATENCY_BUDGET)))
+        else:
+          show(FramePipeline(cap.read, lambda image, timestamp: analyze(image, fps)), fps)
 
         cap.release()
         if SECOND:
           cap2.release()
-        if RECORD:
-          recording.release()
   cv2.destroyAllWindows()
 
 
@@ -204,6 +228,7 @@ def new_tell(result):
 
 
 def draw_on_frame(image, face_landmarks, hands_landmarks):
+  face_landmarks = to_landmark_list(face_landmarks)
   mp.solutions.drawing_utils.draw_landmarks(
       image,
       face_landmarks,
@@ -218,18 +243,16 @@ def draw_on_frame(image, face_landmarks, hands_landmarks):
       landmark_drawing_spec=None,
       connection_drawing_spec=mp.solutions.drawing_styles
       .get_default_face_mesh_iris_connections_style())
-  for hand_landmarks in (hands_landmarks or []):
+  for hand_landmarks in (hands_landmarks if hands_landmarks is not None else []):
     mp.solutions.drawing_utils.draw_landmarks(
         image,
-        hand_landmarks,
+        to_landmark_list(hand_landmarks),
         mp.solutions.hands.HAND_CONNECTIONS,
         mp.solutions.drawing_styles.get_default_hand_landmarks_style(),
         mp.solutions.drawing_styles.get_default_hand_connections_style())
 
 
-def add_text(image, tells, calibrated):
-  global mood
-
+def add_text(image, tells, calibrated, mood=''):
   text_y = TEXT_HEIGHT
   if mood:
     write("Mood: {}".format(mood), image, int(.75 * image.shape[1]), TEXT_HEIGHT)
@@ -248,101 +271,40 @@ def write(text, image, x, y):
     lineType=cv2.LINE_AA, thickness=2)
 
 
-def get_aspect_ratio(top, bottom, right, left):
-  height = dist.euclidean([top.x, top.y], [bottom.x, bottom.y])
-  width = dist.euclidean([right.x, right.y], [left.x, left.y])
-  return height / width
-
-
-def get_area(image, draw, topL, topR, bottomR, bottomL):
-  topY = int((topR.y+topL.y)/2 * image.shape[0])
-  botY = int((bottomR.y+bottomL.y)/2 * image.shape[0])
-  leftX = int((topL.x+bottomL.x)/2 * image.shape[1])
-  rightX = int((topR.x+bottomR.x)/2 * image.shape[1])
-
-  if draw:
-    image = cv2.circle(image, (leftX,topY), 2, (255,0,0), 2)
-    image = cv2.circle(image, (leftX,botY), 2, (255,0,0), 2)
-    image = cv2.circle(image, (rightX,topY), 2, (255,0,0), 2)
-    image = cv2.circle(image, (rightX,botY), 2, (255,0,0), 2)
-
-  return image[topY:botY, rightX:leftX]
-
-
-def get_bpm_tells(cheekL, cheekR, fps, bpm_chart):
-  global hr_times, hr_values, avg_bpms
-  global ax, line, peakpts
-
-  cheekLwithoutBlue = np.average(cheekL[:, :, 1:3])
-  cheekRwithoutBlue = np.average(cheekR[:, :, 1:3])
-  hr_values = hr_values[1:] + [cheekLwithoutBlue + cheekRwithoutBlue]
+def get_bpm_tells(session, color, seconds, bpm_chart):
+  heart_rate = session.heart_rate
 
-  if not fps:
-    hr_times = hr_times[1:] + [time.time() - EPOCH]
+  if color is not None:
+    heart_rate.add(seconds, color)
 
   if bpm_chart:
-    line.set_data(hr_times, hr_values)
-    ax.relim()
-    ax.autoscale()
+    chart.update(heart_rate)
 
-  peaks, _ = find_peaks(hr_values,
-    threshold=.1,
-    distance=5,
-    prominence=.5,
-    wlen=10,
-  )
-
-  peak_times = [hr_times[i] for i in peaks]
-
-  if bpm_chart:
-    peakpts.set_data(peak_times, [hr_values[i] for i in peaks])
-
-  bpms = 60 * np.diff(peak_times) / (fps or 1)
-  bpms = bpms[(bpms > 50) & (bpms < 150)] # filter to reasonable BPM range
-  recent_bpms = bpms[(-3 * RECENT_FRAMES):] # HR slower signal than other tells
-
-  recent_avg_bpm = 0
   bpm_display = "BPM: ..."
-  if recent_bpms.size > 1:
-    recent_avg_bpm = int(np.average(recent_bpms))
-    bpm_display = "BPM: {} ({})".format(recent_avg_bpm, len(recent_bpms))
+  if heart_rate.bpm:
+    bpm_display = "BPM: {}".format(int(heart_rate.bpm))
 
-  avg_bpms = avg_bpms[1:] + [recent_avg_bpm]
-
-  bpm_delta = 0
+  bpm_delta = heart_rate.change() # HR slower signal than other tells, compared over ~30s
   bpm_change = ""
 
-  if len(recent_bpms) > 2:
-    all_bpms = list(filter(lambda bpm: bpm != '-', avg_bpms))
-    all_avg_bpm = sum(all_bpms) / len(all_bpms)
-    avg_recent_bpm = sum(recent_bpms) / len(recent_bpms)
-    bpm_delta = avg_recent_bpm - all_avg_bpm
-
-    if bpm_delta > SIGNIFICANT_BPM_CHANGE:
-      bpm_change = "Heart rate increasing"
-    elif bpm_delta < -SIGNIFICANT_BPM_CHANGE:
-      bpm_change = "Heart rate decreasing"
+  if bpm_delta > SIGNIFICANT_BPM_CHANGE:
+    bpm_change = "Heart rate increasing"
+  elif bpm_delta < -SIGNIFICANT_BPM_CHANGE:
+    bpm_change = "Heart rate decreasing"
 
   return bpm_display, bpm_change
 
 
 def is_blinking(face):
-  eyeR = [face[p] for p in [159, 145, 133, 33]]
-  eyeR_ar = get_aspect_ratio(*eyeR)
-
-  eyeL = [face[p] for p in [386, 374, 362, 263]]
-  eyeL_ar = get_aspect_ratio(*eyeL)
-
-  eyeA_ar = (eyeR_ar + eyeL_ar) / 2
-  return eyeA_ar < EYE_BLINK_HEIGHT
+  return bool(landmarks.get_eye_ratio(face) < EYE_BLINK_HEIGHT)
 
 
 def get_blink_tell(blinks):
-  if sum(blinks[:RECENT_FRAMES]) < 3: # not enough blinks for valid comparison
+  if blinks.head_sum() < 3: # not enough blinks for valid comparison
     return None
 
-  recent_closed = 1.0 * sum(blinks[-RECENT_FRAMES:]) / RECENT_FRAMES
-  avg_closed = 1.0 * sum(blinks) / MAX_FRAMES
+  recent_closed = 1.0 * blinks.tail_sum() / RECENT_FRAMES
+  avg_closed = 1.0 * blinks.sum() / MAX_FRAMES
 
   if recent_closed > (20 * avg_closed):
     return "Increased blinking"
@@ -353,73 +315,36 @@ def get_blink_tell(blinks):
 
 
 def check_hand_on_face(hands_landmarks, face):
-  if hands_landmarks:
-    face_landmarks = [face[p] for p in FACEMESH_FACE_OVAL]
-    face_points = [[[p.x, p.y] for p in face_landmarks]]
-    face_contours = np.array(face_points).astype(np.single)
-
-    for hand_landmarks in hands_landmarks:
-      hand = []
-      for point in hand_landmarks.landmark:
-        hand.append( (point.x, point.y) )
-
-      for finger in [4, 8, 20]:
-        overlap = cv2.pointPolygonTest(face_contours, hand[finger], False)
-        if overlap != -1:
-          return True
-  return False
+  if hands_landmarks is None:
+    return False
+  return bool(landmarks.get_hand_on_face(face, hands_landmarks))
 
 
 def get_avg_gaze(face):
-  gaze_left = get_gaze(face, 476, 474, 263, 362)
-  gaze_right = get_gaze(face, 471, 469, 33, 133)
-  return round((gaze_left + gaze_right) / 2, 1)
-
-
-def get_gaze(face, iris_L_side, iris_R_side, eye_L_corner, eye_R_corner):
-  iris = (
-    face[iris_L_side].x + face[iris_R_side].x,
-    face[iris_L_side].y + face[iris_R_side].y,
-  )
-  eye_center = (
-    face[eye_L_corner].x + face[eye_R_corner].x,
-    face[eye_L_corner].y + face[eye_R_corner].y,
-  )
-
-  gaze_dist = dist.euclidean(iris, eye_center)
-  eye_width = abs(face[eye_R_corner].x - face[eye_L_corner].x)
-  gaze_relative = gaze_dist / eye_width
-
-  if (eye_center[0] - iris[0]) < 0: # flip along x for looking L vs R
-    gaze_relative *= -1
-
-  return gaze_relative
-
+  return float(landmarks.get_avg_gaze(face))
 
-def detect_gaze_change(avg_gaze):
-  global gaze_values
 
-  gaze_values = gaze_values[1:] + [avg_gaze]
+def detect_gaze_change(gaze_values, avg_gaze):
+  gaze_values.append(avg_gaze)
   gaze_relative_matches = 1.0 * gaze_values.count(avg_gaze) / MAX_FRAMES
   if gaze_relative_matches < .01: # looking in a new direction
     return gaze_relative_matches
   return 0
 
 
-def get_lip_ratio(face):
-  return get_aspect_ratio(face[0], face[17], face[61], face[291])
-
-
-def get_mood(image):
-  global emotion_detector, calculating_mood, mood
-
-  detected_mood, score = emotion_detector.top_emotion(image)
-  calculating_mood = False
-  if score and (score > .4 or detected_mood == 'neutral'):
-    mood = detected_mood
+def add_span_stats(image):
+  # rolling mean/max of the slowest spans, bottom right
+  lines = ["{} {:.1f}/{:.0f} ms".format(name, mean, peak) for name, (mean, peak) in list(tracing.stats().items())[:8]]
+  x = image.shape[1] - 330
+  y = image.shape[0] - TEXT_HEIGHT * len(lines)
+  for idx, line in enumerate(lines):
+    cv2.putText(image, line, (x, y + idx * TEXT_HEIGHT), cv2.FONT_HERSHEY_SIMPLEX, .7, (0, 255, 0), 2, cv2.LINE_AA)
 
 
 def add_truth_meter(image, tell_count):
+  global meter
+  if meter is None:
+    meter = cv2.imread('meter.png')
   width = image.shape[1]
   sm = int(width / 64)
   bg = int(width / 3.2)
@@ -432,76 +357,54 @@ def add_truth_meter(image, tell_count):
     cv2.rectangle(image, (tellX, int(.9*sm)), (tellX+int(sm/2), int(2.1*sm)), (0,0,0), 2)
 
 
-def get_face_relative_area(face):
-  face_width = abs(max(face[454].x, 0) - max(face[234].x, 0))
-  face_height = abs(max(face[152].y, 0) - max(face[10].y, 0))
-  return face_width * face_height
-
-
-def find_face_and_hands(image_original, face_mesh, hands):
-  image = image_original.copy()
-  image.flags.writeable = False # pass by reference to improve speed
-  image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-  faces = face_mesh.process(image)
-  hands_landmarks = hands.process(image).multi_hand_landmarks
-
-  face_landmarks = None
-  if faces.multi_face_landmarks and len(faces.multi_face_landmarks) > 0:
-    face_landmarks = faces.multi_face_landmarks[0] # use first face found
-
-  return face_landmarks, hands_landmarks
+def process(session, image, calibrated=False, draw=False, bpm_chart=False, flip=False, fps=None, timestamp=None):
+  frames = session.elapsed_frames(timestamp, fps)
+  seconds = session.clock(timestamp, fps)
+  tells = decrement_tells(session.tells, frames)
 
+  face_landmarks, hands_landmarks = session.find_face_and_hands(image)
+  if face_landmarks is not None:
+    face = face_landmarks
+    session.face_area_size = get_face_relative_area(face)
 
-def process(image, face_mesh, hands, calibrated=False, draw=False, bpm_chart=False, flip=False, fps=None):
-  global tells, calculating_mood
-  global blinks, hand_on_face, face_area_size
-
-  tells = decrement_tells(tells)
-
-  face_landmarks, hands_landmarks = find_face_and_hands(image, face_mesh, hands)
-  if face_landmarks:
-    face = face_landmarks.landmark
-    face_area_size = get_face_relative_area(face)
-
-    if not calculating_mood:
-      emothread = threading.Thread(target=get_mood, args=(image,))
-      emothread.start()
-      calculating_mood = True
+    session.update_mood(image, face, timestamp)
 
     # TODO check cheek visibility?
-    cheekL = get_area(image, draw, topL=face[449], topR=face[350], bottomR=face[429], bottomL=face[280])
-    cheekR = get_area(image, draw, topL=face[121], topR=face[229], bottomR=face[50], bottomL=face[209])
+    color = session.cheeks.sample(image, face)
+    if draw:
+      for x1, y1, x2, y2 in cheek_rects(face, image.shape[1], image.shape[0]):
+        cv2.rectangle(image, (x1, y1), (x2 - 1, y2 - 1), (255,0,0), 2)
 
-    avg_bpms, bpm_change = get_bpm_tells(cheekL, cheekR, fps, bpm_chart)
-    tells['avg_bpms'] = new_tell(avg_bpms) # always show "..." if BPM missing
-    if len(bpm_change):
-      tells['bpm_change'] = new_tell(bpm_change)
+    with span('tell.bpm'):
+      avg_bpms, bpm_change = get_bpm_tells(session, color, seconds, bpm_chart)
+      tells['avg_bpms'] = new_tell(avg_bpms) # always show "..." if BPM missing
+      if len(bpm_change):
+        tells['bpm_change'] = new_tell(bpm_change)
 
     # Blinking
-    blinks = blinks[1:] + [is_blinking(face)]
-    recent_blink_tell = get_blink_tell(blinks)
-    if recent_blink_tell:
-      tells['blinking'] = new_tell(recent_blink_tell)
+    with span('tell.blinking'):
+      hold(session.blinks, is_blinking(face), frames)
+      recent_blink_tell = get_blink_tell(session.blinks)
+      if recent_blink_tell:
+        tells['blinking'] = new_tell(recent_blink_tell)
 
     # Hands on face
-    recent_hand_on_face = check_hand_on_face(hands_landmarks, face)
-    hand_on_face = hand_on_face[1:] + [recent_hand_on_face]
-    if recent_hand_on_face:
-      tells['hand'] = new_tell("Hand covering face")
+    with span('tell.hand'):
+      recent_hand_on_face = check_hand_on_face(hands_landmarks, face)
+      hold(session.hand_on_face, recent_hand_on_face, frames)
+      if recent_hand_on_face:
+        tells['hand'] = new_tell("Hand covering face")
 
     # Gaze tracking
-    avg_gaze = get_avg_gaze(face)
-    if detect_gaze_change(avg_gaze):
-      tells['gaze'] = new_tell("Change in gaze")
+    with span('tell.gaze'):
+      avg_gaze = get_avg_gaze(face)
+      if detect_gaze_change(session.gaze_values, avg_gaze):
+        tells['gaze'] = new_tell("Change in gaze")
 
     # Lip compression
-    if get_lip_ratio(face) < LIP_COMPRESSION_RATIO:
-      tells['lips'] = new_tell("Lip compression")
-
-    if bpm_chart: # update chart
-      fig.canvas.draw()
-      fig.canvas.flush_events()
+    with span('tell.lips'):
+      if get_lip_ratio(face) < LIP_COMPRESSION_RATIO:
+        tells['lips'] = new_tell("Lip compression")
 
     if draw: # overlay face and hand landmarks
       draw_on_frame(image, face_landmarks, hands_landmarks)
@@ -509,10 +412,10 @@ def process(image, face_mesh, hands, calibrated=False, draw=False, bpm_chart=Fal
   if flip:
     image = cv2.flip(image, 1) # flip image horizontally
 
-  add_text(image, tells, calibrated)
+  add_text(image, tells, calibrated, session.mood)
   add_truth_meter(image, len(tells))
 
-  return 1 if (face_landmarks and not calibrated) else 0
+  return 1 if (face_landmarks is not None and not calibrated) else 0
 
 
 def mirror_compare(first, second, rate, less, more):
@@ -523,42 +426,48 @@ def mirror_compare(first, second, rate, less, more):
   return None
 
 def get_blink_comparison(blinks1, blinks2):
-  return mirror_compare(sum(blinks1), sum(blinks2), 1.8, "Blink less", "Blink more")
+  return mirror_compare(blinks1, blinks2, 1.8, "Blink less", "Blink more")
 
 def get_hand_face_comparison(hand1, hand2):
-  return mirror_compare(sum(hand1), sum(hand2), 2.1, "Stop touching face", "Touch face more")
+  return mirror_compare(hand1, hand2, 2.1, "Stop touching face", "Touch face more")
 
 def get_face_size_comparison(ratio1, ratio2):
   return mirror_compare(ratio1, ratio2, 1.5, "Too close", "Too far")
 
 
-# process optional second input for mirroring
-def process_second(cap, image, face_mesh, hands):
-  global blinks, blinks2
-  global hand_on_face, hand_on_face2
-  global face_area_size
+def mirror_stats(session):
+  # what the mirror comparisons need, snapshotted with each result
+  return session.blinks.sum(), session.hand_on_face.sum(), session.face_area_size
 
-  success2, image2 = cap.read()
-  if success2:
-    face_landmarks2, hands_landmarks2 = find_face_and_hands(image2, face_mesh, hands)
 
-    if face_landmarks2:
-      face2 = face_landmarks2.landmark
+# process optional second input for mirroring, on its own stream
+def process_second(mirror_session, image2, fps=None, timestamp=None):
+  face_landmarks2, hands_landmarks2 = mirror_session.find_face_and_hands(image2)
+  frames = mirror_session.elapsed_frames(timestamp, fps)
 
-      blinks2 = blinks2[1:] + [is_blinking(face2)]
-      blink_mirror = get_blink_comparison(blinks, blinks2)
+  if face_landmarks2 is None:
+    return None
+  face2 = face_landmarks2
+
+  hold(mirror_session.blinks, is_blinking(face2), frames)
+  hold(mirror_session.hand_on_face, check_hand_on_face(hands_landmarks2, face2), frames)
+  mirror_session.face_area_size = get_face_relative_area(face2)
 
-      hand_on_face2 = hand_on_face2[1:] + [check_hand_on_face(hands_landmarks2, face2)]
-      hand_face_mirror = get_hand_face_comparison(hand_on_face, hand_on_face2)
+  return mirror_stats(mirror_session)
 
-      face_area_size2 = get_face_relative_area(face2)
-      face_ratio_mirror = get_face_size_comparison(face_area_size, face_area_size2)
 
-      text_y = 2 * TEXT_HEIGHT # show prompts below 'mood' on right side
-      for comparison in [blink_mirror, hand_face_mirror, face_ratio_mirror]:
-        if comparison:
-          write(comparison, image, int(.75 * image.shape[1]), text_y)
-          text_y += TEXT_HEIGHT
+def write_mirror_comparisons(image, stats, mirrored):
+  blinks1, hand1, ratio1 = stats
+  blinks2, hand2, ratio2 = mirrored
+  blink_mirror = get_blink_comparison(blinks1, blinks2)
+  hand_face_mirror = get_hand_face_comparison(hand1, hand2)
+  face_ratio_mirror = get_face_size_comparison(ratio1, ratio2)
+
+  text_y = 2 * TEXT_HEIGHT # show prompts below 'mood' on right side
+  for comparison in [blink_mirror, hand_face_mirror, face_ratio_mirror]:
+    if comparison:
+      write(comparison, image, int(.75 * image.shape[1]), text_y)
+      text_y += TEXT_HEIGHT
 
 
 if __name__ == '__main__':
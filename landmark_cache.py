@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from landmarks import FACE_POINTS, HAND_POINTS
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lie-detector', 'landmarks')
+MAX_CACHE_BYTES = 4 << 30  # the least recently used caches are removed beyond this, about 6 hours of 30 fps video
+MAX_HANDS = 2
+NOT_CACHED = -1  # status of a frame that has not been analyzed yet
+FRAME_BYTES = (FACE_POINTS + MAX_HANDS * HAND_POINTS) * 3 * 4 + 1  # float32 landmarks and the int8 status
+
+
+FINGERPRINT_BYTES = 4 << 20  # hashed from the start of the file
+
+
+def file_fingerprint(file_path, head_bytes=FINGERPRINT_BYTES):
+    # size, modification time and a hash of the first few MB: hashing whole recordings
+    # took seconds before playback could start, and a changed file changes its mtime
+    stat = os.stat(file_path)
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(head_bytes))
+    return '{}-{}-{}'.format(stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+
+def cache_key(file_path, settings):
+    digest = hashlib.sha256(file_fingerprint(file_path).encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def cache_size(directory):
+    try:
+        return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    except OSError:  # removed meanwhile by another process
+        return 0
+
+
+def evict(cache_dir, max_bytes):
+    # removes the least recently opened caches until the rest take at most max_bytes
+    if not os.path.isdir(cache_dir):
+        return
+    caches = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+    caches = sorted((os.path.getmtime(path), path) for path in caches if os.path.isdir(path))
+    total = sum(cache_size(path) for _, path in caches)
+    for _, path in caches:
+        if total <= max_bytes:
+            break
+        total -= cache_size(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def open_cache(file_path, settings, frame_count, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    # The LandmarkCache of a video, or None when it cannot have one: OpenCV reports 0 or a
+    # meaningless, even negative, frame count for some streams (raw MJPEG, live captures),
+    # and a video whose landmarks would not fit in max_bytes would evict everything else.
+    if frame_count <= 0 or frame_count * FRAME_BYTES > max_bytes:
+        return None
+    return LandmarkCache(file_path, settings, frame_count, cache_dir, max_bytes)
+
+
+class LandmarkCache:
+    # Face and hand landmarks per frame, stored as memory-mapped float32 arrays:
+    # landmarks.npy is (frames, 478 + 2 * 21, 3) and status.npy holds, per frame,
+    # NOT_CACHED or (face found) + 2 * (number of hands). Opening a cache marks it as
+    # recently used; creating one first evicts old caches to stay within max_bytes.
+    def __init__(self, file_path, settings, frame_count, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.directory = os.path.join(cache_dir, cache_key(file_path, settings))
+        landmarks_path = os.path.join(self.directory, 'landmarks.npy')
+        status_path = os.path.join(self.directory, 'status.npy')
+        if os.path.exists(status_path):
+            os.utime(self.directory)
+            self.landmarks = np.load(landmarks_path, mmap_mode='r+')
+            self.status = np.load(status_path, mmap_mode='r+')
+        else:
+            evict(cache_dir, max_bytes - frame_count * FRAME_BYTES)
+            os.makedirs(self.directory, exist_ok=True)
+            points = FACE_POINTS + MAX_HANDS * HAND_POINTS
+            self.landmarks = np.lib.format.open_memmap(
+                landmarks_path, mode='w+', dtype=np.float32, shape=(frame_count, points, 3))
+            status = np.lib.format.open_memmap(
+                status_path + '.tmp', mode='w+', dtype=np.int8, shape=(frame_count,))
+            status[:] = NOT_CACHED
+            status.flush()
+            del status
+            os.replace(status_path + '.tmp', status_path)
+            self.status = np.load(status_path, mmap_mode='r+')
+
+    def __len__(self):
+        return len(self.status)
+
+    def get(self, frame_index):
+        # returns (face_landmarks, hands_landmarks) like find_face_and_hands, or None on a miss
+        if frame_index >= len(self.status) or self.status[frame_index] == NOT_CACHED:
+            return None
+        status = int(self.status[frame_index])
+        points = np.array(self.landmarks[frame_index])
+        face_landmarks = points[:FACE_POINTS] if status & 1 else None
+        hands_landmarks = None
+        if status >> 1:
+            hands_landmarks = points[FACE_POINTS:FACE_POINTS + (status >> 1) * HAND_POINTS].reshape(-1, HAND_POINTS, 3)
+        return face_landmarks, hands_landmarks
+
+    def put(self, frame_index, face_landmarks, hands_landmarks):
+        if frame_index >= len(self.status):
+            return
+        hand_count = 0 if hands_landmarks is None else min(len(hands_landmarks), MAX_HANDS)
+        points = self.landmarks[frame_index]
+        points[:] = np.nan
+        if face_landmarks is not None:
+            points[:FACE_POINTS] = face_landmarks
+        if hand_count:
+            points[FACE_POINTS:FACE_POINTS + hand_count * HAND_POINTS] = hands_landmarks[:hand_count].reshape(-1, 3)
+        self.status[frame_index] = (0 if face_landmarks is None else 1) + 2 * hand_count
+
+    def arrays(self):
+        # every cached frame at once: faces (frames, 478, 3) and hands (frames, 2, 21, 3),
+        # with NaN where no face or hand was found, plus the mask of cached frames
+        faces = self.landmarks[:, :FACE_POINTS]
+        hands = self.landmarks[:, FACE_POINTS:].reshape(len(self), MAX_HANDS, HAND_POINTS, 3)
+        return faces, hands, self.status != NOT_CACHED
+
+    def close(self):
+        self.landmarks.flush()
+        self.status.flush()
+
+
+def find_face_and_hands_cached(cache, frame_index, image, session):
+    cached = cache.get(frame_index) if cache is not None else None
+    if cached is not None:
+        return cached
+    face_landmarks, hands_landmarks = session.find_face_and_hands(image)
+    if cache is not None:
+        cache.put(frame_index, face_landmarks, hands_landmarks)
+    return face_landmarks, hands_landmarks
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+
+from landmarks import FACEMESH_FACE_OVAL, EYE_R, EYE_L, LIPS, GAZE_L, GAZE_R, CHEEK_L, CHEEK_R
+
+KEYFRAME_INTERVAL = 5  # run FaceMesh and Hands on every Nth frame
+TRACKED_POINTS = sorted(set(EYE_R + EYE_L + LIPS + GAZE_L + GAZE_R + CHEEK_L + CHEEK_R + FACEMESH_FACE_OVAL))
+MIN_TRACKED = .8  # fraction of points that must be tracked to trust the flow
+MAX_FLOW_ERROR = 1.0  # forward-backward error in pixels
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, .03))
+
+
+class LandmarkTracker:
+    # Runs inference only on keyframes and moves the landmarks the tells depend on (eyes,
+    # irises, lips, cheeks, face oval, fingertips) with pyramidal Lucas-Kanade optical flow
+    # in between. The remaining face points follow the median motion of the tracked ones.
+    def __init__(self, interval=KEYFRAME_INTERVAL):
+        self.interval = interval
+        self.previous = None
+        self.face = None
+        self.hands = None
+        self.since_keyframe = 0
+
+    def reset(self):
+        self.previous = self.face = self.hands = None
+
+    def find_face_and_hands(self, image, find):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        tracked = None
+        if self.face is not None and self.since_keyframe < self.interval - 1:
+            tracked = self.propagate(gray)
+        if tracked is None:
+            self.face, self.hands = find(image)
+            self.since_keyframe = 0
+        else:
+            self.face, self.hands = tracked
+            self.since_keyframe += 1
+        self.previous = gray
+        return self.face, self.hands
+
+    def propagate(self, gray):
+        height, width = gray.shape
+        scale = np.array([width, height], dtype=np.float32)
+        face_points = self.face[TRACKED_POINTS, :2]
+        hand_points = self.hands[..., :2].reshape(-1, 2) if self.hands is not None else np.empty((0, 2), np.float32)
+        points = (np.concatenate((face_points, hand_points)) * scale).reshape(-1, 1, 2).astype(np.float32)
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.previous, gray, points, None, **LK_PARAMS)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous, moved, None, **LK_PARAMS)
+        error = np.linalg.norm((back - points).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < MAX_FLOW_ERROR)
+        if good[:len(TRACKED_POINTS)].mean() < MIN_TRACKED:
+            return None  # tracking confidence dropped, run a keyframe instead
+
+        motion = (moved - points).reshape(-1, 2) / scale
+        median = np.median(motion[good], axis=0)
+        motion[~good] = median
+
+        face = self.face.copy()
+        face[:, :2] += median
+        face[TRACKED_POINTS, :2] = self.face[TRACKED_POINTS, :2] + motion[:len(TRACKED_POINTS)]
+        hands = None
+        if self.hands is not None:
+            hands = self.hands.copy()
+            hands[..., :2] += motion[len(TRACKED_POINTS):].reshape(self.hands.shape[:-1] + (2,))
+        return face, hands
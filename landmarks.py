@@ -0,0 +1,104 @@
+import numpy as np
+
+FACE_POINTS = 478
+HAND_POINTS = 21
+FACEMESH_FACE_OVAL = [10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 361, 288, 397, 365, 379, 378, 400, 377, 152, 148, 176, 149, 150, 136, 172, 58, 132, 93, 234, 127, 162, 21, 54, 103, 67, 109, 10]
+FINGERTIPS = [4, 8, 20]
+EYE_R = [159, 145, 133, 33]  # top, bottom, right, left
+EYE_L = [386, 374, 362, 263]
+LIPS = [0, 17, 61, 291]
+GAZE_L = [476, 474, 263, 362]  # iris left side, iris right side, eye left corner, eye right corner
+GAZE_R = [471, 469, 33, 133]
+CHEEK_L = [449, 350, 429, 280]  # top left, top right, bottom right, bottom left
+CHEEK_R = [121, 229, 50, 209]
+
+# Every kernel below takes a single face of shape (478, 3) or a batch of shape
+# (frames, 478, 3) and returns a scalar or a (frames,) array respectively.
+
+
+def face_to_array(face_landmarks):
+    if face_landmarks is None:
+        return None
+    return np.array([(p.x, p.y, p.z) for p in face_landmarks.landmark], dtype=np.float32)
+
+
+def hands_to_array(hands_landmarks):
+    if not hands_landmarks:
+        return None
+    return np.array([[(p.x, p.y, p.z) for p in hand.landmark] for hand in hands_landmarks], dtype=np.float32)
+
+
+def to_landmark_list(points):
+    # back to MediaPipe's protobuf, only needed for mediapipe's drawing utilities
+    from mediapipe.framework.formats import landmark_pb2
+    return landmark_pb2.NormalizedLandmarkList(landmark=[
+        landmark_pb2.NormalizedLandmark(x=x, y=y, z=z) for x, y, z in np.asarray(points).tolist()])
+
+
+def xy(face, indices):
+    return np.asarray(face)[..., indices, :2].astype(np.float64)
+
+
+def get_aspect_ratio(face, top, bottom, right, left):
+    points = xy(face, [top, bottom, right, left])
+    height = np.linalg.norm(points[..., 0, :] - points[..., 1, :], axis=-1)
+    width = np.linalg.norm(points[..., 2, :] - points[..., 3, :], axis=-1)
+    return height / width
+
+
+def get_eye_ratio(face):
+    return (get_aspect_ratio(face, *EYE_R) + get_aspect_ratio(face, *EYE_L)) / 2
+
+
+def get_lip_ratio(face):
+    return get_aspect_ratio(face, *LIPS)
+
+
+def get_gaze(face, iris_L_side, iris_R_side, eye_L_corner, eye_R_corner):
+    points = xy(face, [iris_L_side, iris_R_side, eye_L_corner, eye_R_corner])
+    iris = points[..., 0, :] + points[..., 1, :]
+    eye_center = points[..., 2, :] + points[..., 3, :]
+    gaze_dist = np.linalg.norm(iris - eye_center, axis=-1)
+    eye_width = np.abs(points[..., 3, 0] - points[..., 2, 0])
+    gaze_relative = gaze_dist / eye_width
+    return np.where(eye_center[..., 0] - iris[..., 0] < 0, -gaze_relative, gaze_relative)  # flip along x for looking L vs R
+
+
+def get_avg_gaze(face):
+    return np.round((get_gaze(face, *GAZE_L) + get_gaze(face, *GAZE_R)) / 2, 1)
+
+
+def get_face_relative_area(face):
+    points = np.maximum(xy(face, [454, 234, 152, 10]), 0)
+    face_width = np.abs(points[..., 0, 0] - points[..., 1, 0])
+    face_height = np.abs(points[..., 2, 1] - points[..., 3, 1])
+    return face_width * face_height
+
+
+def points_in_polygon(points, polygon):
+    # even-odd rule; points (..., m, 2), polygon (..., n, 2) -> (..., m)
+    x, y = points[..., :, None, 0], points[..., :, None, 1]
+    x1, y1 = polygon[..., None, :, 0], polygon[..., None, :, 1]
+    x2, y2 = np.roll(x1, -1, axis=-1), np.roll(y1, -1, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+    return np.count_nonzero(crossings, axis=-1) % 2 == 1
+
+
+def get_hand_on_face(face, hands):
+    # hands (..., hands, 21, 3); missing hands may be filled with NaN
+    fingertips = xy(hands, FINGERTIPS)
+    fingertips = fingertips.reshape(fingertips.shape[:-3] + (-1, 2))
+    return points_in_polygon(fingertips, xy(face, FACEMESH_FACE_OVAL)).any(axis=-1)
+
+
+def get_face_features(faces, hands=None):
+    features = {
+        'eye_ratio': get_eye_ratio(faces),
+        'lip_ratio': get_lip_ratio(faces),
+        'gaze': get_avg_gaze(faces),
+        'face_area': get_face_relative_area(faces),
+    }
+    if hands is not None:
+        features['hand_on_face'] = get_hand_on_face(faces, hands)
+    return features
@@ -1,5 +1,6 @@
+import threading
+
 import pygame
-from video_processing import play_video, play_webcam
 from utils import get_video_file
 
 # Global variables for screen dimensions
@@ -31,11 +32,18 @@ def draw_checkbox(screen, rect, is_checked, font, label):
     text_surf = font.render(label, True, COLOR_TEXT)
     screen.blit(text_surf, (rect.x + rect.width + 10, rect.y + (rect.height - text_surf.get_height()) // 2))
 
+def warm_up():
+    # the analysis modules and models load in the background while the menu is shown
+    import video_processing
+    import deception_detection
+    deception_detection.warm_up()
+
 def main_menu():
     global screen
     pygame.init()
     screen = pygame.display.set_mode((screen_width, screen_height))
     pygame.display.set_caption('Select Input')
+    threading.Thread(target=warm_up, daemon=True).start()
 
     font = pygame.font.Font(None, 36)
     title_font = pygame.font.Font(None, 48)
@@ -65,11 +73,13 @@ def main_menu():
                 running = False
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if webcam_button.collidepoint(event.pos):
+                    from video_processing import play_webcam  # waits for the warm-up if it is still importing
                     play_webcam(screen, draw_landmarks)
                     screen = pygame.display.set_mode((screen_width, screen_height))  # Reinitialize Pygame display after exiting playback
                 if video_button.collidepoint(event.pos):
                     video_file = get_video_file()
                     if video_file:
+                        from video_processing import play_video
                         play_video(video_file, screen, draw_landmarks)
                         screen = pygame.display.set_mode((screen_width, screen_height))  # Reinitialize Pygame display after exiting playback
                 if settings_checkbox.collidepoint(event.pos):
@@ -88,6 +98,8 @@ def main_menu():
 
         pygame.display.flip()
 
+    import deception_detection  # already loaded by the warm-up
+    deception_detection.model_pool.close()
     pygame.quit()
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+import threading
+
+MAX_IDLE = 4  # graph pairs kept between sessions: a full-frame and a crop pair for two streams
+
+
+class ModelPool:
+    # Owns the FaceMesh and Hands graphs and the FER model for every session in the process.
+    # Sessions acquire a (face_mesh, hands) pair and release it when they close; released
+    # graphs are reset, so the next session starts without the previous one's tracking state
+    # but skips building the graphs again. Graphs beyond MAX_IDLE are closed when released.
+    # FER has no per-session state and is shared.
+    def __init__(self, face_mesh_settings, hands_settings, max_idle=MAX_IDLE):
+        self.face_mesh_settings = face_mesh_settings
+        self.hands_settings = hands_settings
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.fer_lock = threading.Lock()
+        self.fer = None
+        self.created = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.create()
+
+    def create(self):
+        import mediapipe as mp
+        with self.lock:
+            self.created += 1
+        return mp.solutions.face_mesh.FaceMesh(**self.face_mesh_settings), mp.solutions.hands.Hands(**self.hands_settings)
+
+    def release(self, models):
+        for model in models:
+            model.reset()  # drops the landmarks tracked from the previous frames
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(models)
+                return
+        for model in models:
+            model.close()
+
+    def warm_up(self, count=1):
+        # builds graphs ahead of the first session
+        with self.lock:
+            missing = count - len(self.idle)
+        for _ in range(missing):
+            models = self.create()
+            with self.lock:
+                self.idle.append(models)
+
+    def emotion_detector(self):
+        # FER pulls in TensorFlow, so it is only imported once a session asks for mood
+        with self.fer_lock:
+            if self.fer is None:
+                from fer import FER
+                self.fer = FER(mtcnn=False)  # faces come from FaceMesh, so FER's own detector is not used
+        return self.fer
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for models in idle:
+            for model in models:
+                model.close()
@@ -0,0 +1,127 @@
+import argparse
+import json
+import sys
+import time
+
+import cv2
+
+from deception_detection import DetectorSession, MAX_FRAMES, FACE_MESH_SETTINGS, HANDS_SETTINGS
+from landmark_cache import open_cache, find_face_and_hands_cached
+from landmarks import get_face_features
+from emotion import MOOD_RATE
+import tracing
+
+
+def model_settings(roi=False, keyframe_interval=1):
+    settings = [FACE_MESH_SETTINGS, HANDS_SETTINGS]
+    if roi:
+        settings.append({'roi': True})
+    if keyframe_interval > 1:
+        settings.append({'keyframe_interval': keyframe_interval})
+    return settings
+
+
+def analyze_video(file_path, ttl_for_tells=30, use_cache=True, roi=False, keyframe_interval=1, mood=True, start=0, end=None, warmup=0):
+    # yields frames start..end (exclusive, None for the last); the `warmup` frames before
+    # start are analyzed too, without output, to fill the windows as a run from frame 0 would
+    cap = cv2.VideoCapture(file_path)
+    if not cap.isOpened():
+        raise IOError("Could not open video file: {}".format(file_path))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    session = DetectorSession(mood_rate=MOOD_RATE if mood else 0, roi=roi, keyframe_interval=keyframe_interval, frame_clock_mood=True)
+    cache = None
+    if use_cache:
+        cache = open_cache(file_path, model_settings(roi, keyframe_interval), int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    frame_index = 0
+    while frame_index < start - warmup and cap.grab():  # decoding up to it, seeking is not frame-exact for every codec
+        frame_index += 1
+    session.frame_count = frame_index  # the heart rate clock counts frames from the start of the video
+    calibrated = frame_index >= MAX_FRAMES
+    try:
+        while end is None or frame_index < end:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if frame_index < start:  # these frames' cache entries belong to whoever outputs them
+                face_landmarks, hands_landmarks = (cache.get(frame_index) if cache is not None else None) or session.find_face_and_hands(frame)
+            else:
+                face_landmarks, hands_landmarks = find_face_and_hands_cached(cache, frame_index, frame, session)
+            tells = session.process_frame(frame, face_landmarks, hands_landmarks, calibrated, fps=fps, ttl_for_tells=ttl_for_tells)
+            if frame_index < start:
+                frame_index += 1
+                calibrated = frame_index >= MAX_FRAMES
+                continue
+            yield {
+                'frame': frame_index,
+                'time': round(frame_index / fps, 3),
+                'face': face_landmarks is not None,
+                'calibrated': calibrated,
+                'bpm': session.bpm,
+                'mood': session.mood or None,
+                'tells': {key: tell['text'] for key, tell in tells.items()},
+            }
+            frame_index += 1
+            if frame_index >= MAX_FRAMES:
+                calibrated = True
+    finally:
+        cap.release()
+        if cache is not None:
+            cache.close()
+        session.close()
+
+
+def video_features(file_path, roi=False, keyframe_interval=1):
+    # geometric features of every frame in one vectorized call, using the landmarks cached by analyze_video
+    cap = cv2.VideoCapture(file_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    cache = open_cache(file_path, model_settings(roi, keyframe_interval), frame_count)
+    if cache is None:
+        raise IOError("Landmarks of this video cannot be cached: {}".format(file_path))
+    faces, hands, cached = cache.arrays()
+    return get_face_features(faces[cached], hands[cached]), cached
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze a video file without a display, as fast as possible')
+    parser.add_argument('--input', '-i', required=True, help='Path of the video file to analyze')
+    parser.add_argument('--output', '-o', help='Path of the JSON Lines file to write, defaults to stdout')
+    parser.add_argument('--ttl', '-t', help='How many frames for each "tell" to last, defaults to 30', default='30')
+    parser.add_argument('--nocache', '-n', help='Set to any value to skip the landmark cache and always run inference')
+    parser.add_argument('--roi', '-c', help='Set to any value to run face and hand detection only on a crop around the tracked face')
+    parser.add_argument('--keyframes', '-k', help='Run face and hand detection every N frames and track landmarks with optical flow in between, defaults to 1 (every frame)', default='1')
+    parser.add_argument('--nomood', '-m', help='Set to any value to skip mood detection, which also skips loading TensorFlow')
+    parser.add_argument('--workers', '-j', help='Split the video into chunks analyzed on this many processes, defaults to 1; until the landmark cache is filled, results near the start of a chunk can differ slightly from a single pass')
+    parser.add_argument('--warmup', '-w', help='Seconds analyzed before each chunk to fill the heart rate and calibration history, defaults to 41')
+    parser.add_argument('--trace', '-p', help='Path of a Chrome/Perfetto trace file of timed spans to write on exit')
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable(args.trace)
+
+    ttl_for_tells = int(args.ttl) if args.ttl.isdigit() else 30
+    keyframe_interval = int(args.keyframes) if args.keyframes.isdigit() else 1
+    output = open(args.output, 'w') if args.output else sys.stdout
+    workers = int(args.workers) if args.workers and args.workers.isdigit() else 1
+    options = {'ttl_for_tells': ttl_for_tells, 'use_cache': args.nocache is None, 'roi': args.roi is not None, 'keyframe_interval': keyframe_interval, 'mood': args.nomood is None}
+    if workers > 1:
+        from parallel_analysis import analyze_video_parallel, WARMUP_SECONDS
+        warmup_seconds = float(args.warmup) if args.warmup else WARMUP_SECONDS
+        results = analyze_video_parallel(args.input, workers, warmup_seconds=warmup_seconds, **options)
+    else:
+        results = analyze_video(args.input, **options)
+    start = time.time()
+    frames = 0
+    try:
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+            frames += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.time() - start
+    print("Analyzed {} frames in {:.1f}s ({:.1f} fps)".format(frames, elapsed, frames / elapsed if elapsed else 0), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import json
+import math
+import os
+import tempfile
+
+import cv2
+
+from batch_analysis import worker_pool
+from deception_detection import MAX_FRAMES
+from heart_rate import WINDOW_SECONDS, HISTORY, UPDATE_INTERVAL
+from landmark_cache import open_cache
+from offline_analysis import analyze_video, model_settings
+
+# frames analyzed before each chunk without output: the heart rate window plus the
+# estimates a BPM change is measured against, and at least the calibration and a tell's ttl
+WARMUP_SECONDS = WINDOW_SECONDS + HISTORY * UPDATE_INTERVAL + 1
+
+
+def warmup_frames(fps, ttl_for_tells=30, seconds=WARMUP_SECONDS):
+    return max(int(math.ceil(seconds * fps)), MAX_FRAMES + ttl_for_tells)
+
+
+def chunk_bounds(frame_count, chunks):
+    # (start, end) of each chunk; the last one runs to the end, whatever the container's frame count says
+    bounds = [(frame_count * i // chunks, frame_count * (i + 1) // chunks) for i in range(chunks)]
+    bounds[-1] = (bounds[-1][0], None)
+    return bounds
+
+
+def analyze_chunk(job):
+    # runs in a worker process
+    file_path, start, end, warmup, options, output = job
+    with open(output, 'w') as results:
+        for result in analyze_video(file_path, start=start, end=end, warmup=warmup, **options):
+            results.write(json.dumps(result) + '\n')
+    return output
+
+
+def analyze_video_parallel(file_path, workers, threads=1, warmup_seconds=WARMUP_SECONDS, **options):
+    # Yields the same results as analyze_video, in order, from chunks of the video analyzed
+    # on `workers` processes. Each chunk starts `warmup` frames early so that its heart rate,
+    # calibration and tells have the history they would have in a single pass.
+    cap = cv2.VideoCapture(file_path)
+    if not cap.isOpened():
+        raise IOError("Could not open video file: {}".format(file_path))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    warmup = warmup_frames(fps, options.get('ttl_for_tells', 30), warmup_seconds)
+    # a chunk shorter than its warm-up would mostly repeat the work of the one before
+    chunks = max(1, min(workers, frame_count // max(warmup, 1)))
+    if chunks == 1:
+        yield from analyze_video(file_path, **options)
+        return
+    if options.get('use_cache', True):  # created once here, the workers only open it
+        cache = open_cache(file_path, model_settings(options.get('roi', False), options.get('keyframe_interval', 1)), frame_count)
+        if cache is not None:
+            cache.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        jobs = [(file_path, start, end, warmup, options, os.path.join(directory, '{}.jsonl'.format(i)))
+                for i, (start, end) in enumerate(chunk_bounds(frame_count, chunks))]
+        with worker_pool(chunks, threads) as pool:  # see batch_analysis.worker_pool
+            for output in pool.imap(analyze_chunk, jobs):
+                with open(output) as results:
+                    for line in results:
+                        yield json.loads(line)
+                os.remove(output)
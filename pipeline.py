@@ -0,0 +1,324 @@
+import math
+import queue
+import threading
+import time
+from collections import deque
+
+from tracing import span
+
+QUEUE_SIZE = 2
+END_OF_STREAM = object()
+LATENCY_BUDGET = .15  # seconds from capture to display for live sources
+MAX_STRIDE = 8  # never run inference on fewer than every 8th captured frame
+SMOOTHING = .1
+HISTORY = 30  # recent results kept to line up several streams by capture time
+
+
+def put_latest(frames, item):
+    # drop-oldest: make room for the newest item instead of blocking the producer
+    dropped = 0
+    while True:
+        try:
+            frames.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                frames.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+
+def drain(frames):
+    while True:
+        try:
+            frames.get_nowait()
+        except queue.Empty:
+            return
+
+
+class LatencyController:
+    # Keeps the capture-to-display latency of a live source within `budget` seconds.
+    # Tracks a running average of every stage and lets only every `stride`th captured
+    # frame through to inference: at least as many as arrive during one inference, and
+    # more while the budget is still exceeded.
+    def __init__(self, budget=LATENCY_BUDGET, max_stride=MAX_STRIDE, smoothing=SMOOTHING):
+        self.budget = budget
+        self.max_stride = max_stride
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.stages = {}  # stage -> average seconds
+        self.warm = set()
+        self.stride = 1
+        self.captured = 0
+        self.skipped = 0
+        self.last_capture = None
+        self.next_adjust = 0
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.warm:
+                self.warm.add(stage)  # the first sample includes model start-up
+                return
+            average = self.stages.get(stage)
+            self.stages[stage] = seconds if average is None else average + self.smoothing * (seconds - average)
+
+    def average(self, stage):
+        with self.lock:
+            return self.stages.get(stage, 0)
+
+    def admit(self, timestamp):
+        # called for every captured frame
+        if self.last_capture is not None:
+            self.record('interval', timestamp - self.last_capture)
+        self.last_capture = timestamp
+        with self.lock:
+            self.captured += 1
+            if self.captured % self.stride == 0:
+                return True
+            self.skipped += 1
+            return False
+
+    def stale(self, timestamp):
+        # true when the frame can no longer be shown within the budget
+        remaining = self.average('inference') + self.average('render')
+        return time.time() - timestamp + remaining > self.budget
+
+    def displayed(self, timestamp):
+        now = time.time()
+        self.record('latency', now - timestamp)
+        latency = self.average('latency') + self.average('render')
+        interval = self.average('interval')
+        needed = math.ceil(self.average('inference') / interval) if interval else 1
+        with self.lock:
+            if 'latency' not in self.stages or now < self.next_adjust:
+                return
+            self.next_adjust = now + self.budget  # give the last change time to show
+            if latency > self.budget:
+                self.stride = min(max(self.stride + 1, needed), self.max_stride)
+            elif latency < .8 * self.budget and self.stride > max(needed, 1):
+                self.stride -= 1
+
+
+class FramePipeline:
+    # capture -> inference -> render, each stage on its own thread connected by bounded queues;
+    # infer(frame, timestamp) gets the time.time() at which the frame was captured
+    def __init__(self, read_frame, infer, live=False, queue_size=QUEUE_SIZE, controller=None):
+        self.read_frame = read_frame
+        self.infer = infer
+        self.live = live
+        self.controller = controller
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue(maxsize=queue_size)
+        self.running = threading.Event()
+        self.paused = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = None
+        self.generation = 0
+        self.dropped = 0
+        self.history = deque(maxlen=HISTORY)
+        self.timestamp = None
+        self.scheduler = None  # set by StreamScheduler, which then runs inference instead
+        self.threads = []
+
+    def start(self):
+        self.running.set()
+        self.threads = [threading.Thread(target=self.capture_loop, name='capture', daemon=True)]
+        if self.scheduler is None:
+            self.threads.append(threading.Thread(target=self.inference_loop, name='inference', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.running.clear()
+        drain(self.frames)
+        drain(self.results)
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.threads = []
+
+    def pause(self):
+        self.paused.set()
+
+    def resume(self):
+        self.paused.clear()
+
+    def run_in_capture(self, action):
+        # run action (e.g. a seek) on the capture thread and discard frames read before it
+        with self.lock:
+            self.pending = action
+
+    def put(self, frames, item):
+        if self.live:
+            with self.lock:
+                self.dropped += put_latest(frames, item)
+            return True
+        while self.running.is_set():
+            try:
+                frames.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def capture_loop(self):
+        while self.running.is_set():
+            with self.lock:
+                action, self.pending = self.pending, None
+            if action:
+                action()
+                with self.lock:
+                    self.generation += 1
+                    self.history.clear()
+                drain(self.frames)
+                drain(self.results)
+            if self.paused.is_set():
+                self.running.wait(.01)
+                continue
+            started = time.time()
+            with span('read'):
+                ret, frame = self.read_frame()
+            timestamp = time.time()
+            if not ret:
+                self.put(self.frames, END_OF_STREAM)
+                return
+            if frame is None:
+                continue  # the source had nothing new, e.g. an unchanged screen
+            if self.controller:
+                self.controller.record('capture', timestamp - started)
+                if not self.controller.admit(timestamp):
+                    continue
+            if not self.put(self.frames, (self.generation, timestamp, frame)):
+                return
+            if self.scheduler:
+                self.scheduler.notify()
+
+    def inference_loop(self):
+        while self.running.is_set():
+            try:
+                item = self.frames.get(timeout=.1)
+            except queue.Empty:
+                continue
+            if not self.handle(item):
+                return
+
+    def handle(self, item):
+        # runs inference on one captured item; False once the stream is over
+        if item is END_OF_STREAM:
+            self.put(self.results, END_OF_STREAM)
+            return False
+        generation, timestamp, frame = item
+        started = time.time()
+        if self.controller:
+            if not self.frames.empty() and self.controller.stale(timestamp):
+                with self.lock:
+                    self.dropped += 1
+                return True  # a newer frame is already waiting
+            self.controller.record('queue', started - timestamp)
+        with span('infer'):
+            result = self.infer(frame, timestamp)
+        if self.controller:
+            self.controller.record('inference', time.time() - started)
+        with self.lock:
+            if generation == self.generation:
+                self.history.append((timestamp, result))
+        return self.put(self.results, (generation, timestamp, result))
+
+    def nearest(self, timestamp):
+        # the latest results' closest match to a capture time, e.g. from another stream
+        with self.lock:
+            history = list(self.history)
+        if not history:
+            return None
+        return min(history, key=lambda item: abs(item[0] - timestamp))[1]
+
+    def get(self, timeout=None):
+        # returns the next result, None if nothing arrived in time, or END_OF_STREAM
+        while True:
+            try:
+                item = self.results.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if item is END_OF_STREAM:
+                return item
+            generation, timestamp, result = item
+            if generation == self.generation:
+                self.timestamp = timestamp  # capture time of the result just returned
+                if self.controller:
+                    self.controller.displayed(timestamp)
+                return result
+
+
+class StreamScheduler:
+    # Runs inference for several FramePipelines on a shared pool of worker threads; each
+    # pipeline keeps its own capture thread, models and detector state. A free worker takes
+    # the ready stream with the least service relative to its priority (stride scheduling,
+    # so a priority 2 stream gets twice the turns of a priority 1 stream when both are
+    # behind), and never two frames of one stream at once, so sessions see frames in order.
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.streams = []
+        self.condition = threading.Condition()
+        self.running = False
+        self.virtual_time = 0
+        self.threads = []
+
+    def add(self, pipeline, priority=1):
+        pipeline.scheduler = self
+        self.streams.append({'pipeline': pipeline, 'priority': priority, 'pass': 0, 'busy': False, 'done': False})
+        return pipeline
+
+    def start(self):
+        self.running = True
+        for stream in self.streams:
+            stream['pipeline'].start()
+        self.threads = [threading.Thread(target=self.worker_loop, name='inference', daemon=True) for _ in range(self.workers or len(self.streams))]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.threads = []
+        for stream in self.streams:
+            stream['pipeline'].stop()
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify()
+
+    def next_stream(self):
+        ready = [stream for stream in self.streams
+                 if not stream['busy'] and not stream['done'] and not stream['pipeline'].frames.empty()]
+        if not ready:
+            return None
+        stream = min(ready, key=lambda stream: stream['pass'])
+        stream['pass'] = max(stream['pass'], self.virtual_time)  # an idle stream does not bank turns
+        self.virtual_time = stream['pass']
+        return stream
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                stream = self.next_stream() if self.running else None
+                while self.running and stream is None:
+                    self.condition.wait(.1)
+                    stream = self.next_stream()
+                if not self.running:
+                    return
+                stream['busy'] = True
+            pipeline = stream['pipeline']
+            try:
+                alive = pipeline.handle(pipeline.frames.get_nowait())
+            except queue.Empty:
+                alive = True  # drained by a seek or stop
+            with self.condition:
+                stream['busy'] = False
+                stream['done'] = not alive
+                stream['pass'] += 1 / stream['priority']
+                self.condition.notify()
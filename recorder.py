@@ -0,0 +1,95 @@
+import queue
+import threading
+
+import cv2
+
+RECORD_QUEUE_SIZE = 64  # frames waiting for the encoder before new ones are dropped
+MEASURE_SECONDS = 1.0  # frames buffered to measure the source rate before the file is opened
+DEFAULT_FPS = 10  # when a recording ends before its rate could be measured
+MAX_REPEAT_SECONDS = 10  # longest gap (e.g. a pause) filled with the previous frame
+STOP = object()
+
+
+class Recorder:
+    # Writes frames to a video file on a background thread, so a slow disk never holds up
+    # analysis. Frames are copied into a bounded queue and dropped (and counted) when the
+    # encoder falls behind. The file is written at `fps`, or at the rate measured over the
+    # first second; frames with capture timestamps are placed by them, repeating the last
+    # frame over gaps and skipping early ones, so the recording plays back at real speed.
+    def __init__(self, path, fps=None, fourcc='MJPG', queue_size=RECORD_QUEUE_SIZE):
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.pending = []
+        self.writer = None
+        self.start = None
+        self.last = None
+        self.position = 0  # index of the next frame on the output timeline
+        self.written = 0  # frames written, fewer than position when a long gap was cut short
+        self.dropped = 0  # the queue was full
+        self.skipped = 0  # arrived faster than the output rate
+        self.thread = threading.Thread(target=self.run, name='recorder', daemon=True)
+        self.thread.start()
+
+    def write(self, frame, timestamp=None):
+        # timestamp: capture time in seconds, or None to write frames back to back
+        try:
+            self.frames.put_nowait((frame.copy(), timestamp))  # sources may reuse their buffers
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.frames.put(STOP)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.frames.get()
+            if item is STOP:
+                break
+            if self.writer is None:
+                self.pending.append(item)
+                if self.fps is None and not self.measure():
+                    continue
+                self.open()
+            else:
+                self.encode(*item)
+        if self.writer is None and self.pending:
+            self.fps = self.fps or self.measure() or DEFAULT_FPS
+            self.open()
+        if self.writer is not None:
+            self.writer.release()
+
+    def measure(self):
+        times = [timestamp for _, timestamp in self.pending if timestamp is not None]
+        if len(times) < 2 or times[-1] - times[0] < MEASURE_SECONDS:
+            return None
+        self.fps = (len(times) - 1) / (times[-1] - times[0])
+        return self.fps
+
+    def open(self):
+        height, width = self.pending[0][0].shape[:2]
+        self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+        for item in self.pending:
+            self.encode(*item)
+        self.pending = []
+
+    def encode(self, frame, timestamp):
+        if timestamp is None:
+            index = self.position
+        else:
+            if self.start is None:
+                self.start = timestamp
+            index = round((timestamp - self.start) * self.fps)
+        if index < self.position:
+            self.skipped += 1
+            return
+        if self.last is not None:
+            for _ in range(min(index - self.position, int(MAX_REPEAT_SECONDS * self.fps))):
+                self.writer.write(self.last)
+                self.written += 1
+        self.writer.write(frame)
+        self.written += 1
+        self.position = index + 1
+        self.last = frame
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class RingBuffer:
+    # Fixed-size sliding window over the last `capacity` values. Appending is O(1) and
+    # allocation-free, and keeps running sums of the whole window and of its oldest and
+    # newest `edge` values, plus (optionally) a count of every distinct value in it.
+    def __init__(self, capacity, fill=0, dtype=np.float64, edge=0, counts=False):
+        self.capacity = capacity
+        self.edge = min(edge, capacity)
+        self.data = np.full(capacity, fill, dtype=dtype)
+        self.start = 0  # physical index of the oldest value
+        self.appended = 0
+        self.counts = {self.data[0].item(): capacity} if counts else None
+        self.recompute()
+
+    def recompute(self):
+        # running float sums slowly drift, so they are rebuilt once per full cycle
+        values = self.values()
+        self.total = values.sum().item()
+        self.head_total = values[:self.edge].sum().item()
+        self.tail_total = values[self.capacity - self.edge:].sum().item()
+
+    def append(self, value):
+        start = self.start
+        oldest = self.data[start].item()
+        leaving_tail = self.data[(start + self.capacity - self.edge) % self.capacity].item()
+        self.data[start] = value
+        value = self.data[start].item()
+        # read after the write: with edge == capacity the entering value is the new one
+        entering_head = self.data[(start + self.edge) % self.capacity].item()
+        self.start = (start + 1) % self.capacity
+
+        self.total += value - oldest
+        if self.edge:
+            self.head_total += entering_head - oldest
+            self.tail_total += value - leaving_tail
+        if self.counts is not None:
+            if self.counts[oldest] == 1:
+                del self.counts[oldest]
+            else:
+                self.counts[oldest] -= 1
+            self.counts[value] = self.counts.get(value, 0) + 1
+
+        self.appended += 1
+        if self.appended % self.capacity == 0 and self.data.dtype.kind == 'f':
+            self.recompute()
+        return oldest
+
+    def __len__(self):
+        return self.capacity
+
+    def sum(self):
+        return self.total
+
+    def head_sum(self):
+        return self.head_total
+
+    def tail_sum(self):
+        return self.tail_total
+
+    def mean(self):
+        return self.total / self.capacity
+
+    def count(self, value):
+        return self.counts.get(value, 0)
+
+    def latest(self):
+        return self.data[self.start - 1].item()
+
+    def values(self, out=None):
+        # oldest to newest; pass `out` to reuse an existing array of the same size
+        return np.concatenate((self.data[self.start:], self.data[:self.start]), out=out)
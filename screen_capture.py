@@ -0,0 +1,66 @@
+import time
+from collections import deque
+
+import cv2
+import mss
+import numpy as np
+
+POOL_SIZE = 8  # frames in flight at once: pipeline queues, inference, display and the next grab
+SAMPLE_STEP = 16  # compare every 16th pixel in each direction to spot unchanged frames
+DUPLICATE_THRESHOLD = 1.0  # mean absolute difference of the samples
+DUPLICATE_WAIT = .01  # seconds to wait before grabbing again after an unchanged frame
+RATE_FRAMES = 30  # changed frames the capture rate is measured over
+
+
+class ScreenSource:
+    # A screen region as a video source. The grab is wrapped without copying, converted from
+    # BGRA once into a small pool of reused BGR frames, and frames that have not changed since
+    # the last one returned (e.g. a video call between its own frames) are reported as
+    # (True, None) so no inference runs on them. A returned frame is overwritten POOL_SIZE
+    # reads later. mss handles only work on the thread that created them, so the first
+    # read() creates one on the capture thread. `fps` is the rate of changed frames, the
+    # median over the last RATE_FRAMES so a paused screen does not skew it, or None at first.
+    def __init__(self, region, skip_duplicates=True, pool_size=POOL_SIZE):
+        self.region = region
+        self.skip_duplicates = skip_duplicates
+        self.pool = [np.empty((region['height'], region['width'], 3), dtype=np.uint8) for _ in range(pool_size)]
+        self.next_frame = 0
+        self.samples = None
+        self.duplicates = 0
+        self.intervals = deque(maxlen=RATE_FRAMES)
+        self.last_change = None
+        self.fps = None
+        self.sct = None
+
+    def read(self):
+        if self.sct is None:
+            self.sct = mss.mss()
+        shot = self.sct.grab(self.region)
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        if self.skip_duplicates and self.unchanged(bgra):
+            self.duplicates += 1
+            time.sleep(DUPLICATE_WAIT)
+            return True, None
+        self.measure(time.time())
+        frame = self.pool[self.next_frame]
+        self.next_frame = (self.next_frame + 1) % len(self.pool)
+        cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=frame)
+        return True, frame
+
+    def measure(self, now):
+        if self.last_change is not None and now > self.last_change:
+            self.intervals.append(now - self.last_change)
+            self.fps = 1 / float(np.median(self.intervals))
+        self.last_change = now
+
+    def unchanged(self, bgra):
+        samples = np.ascontiguousarray(bgra[::SAMPLE_STEP, ::SAMPLE_STEP, :3])  # a few KB
+        if self.samples is not None and cv2.absdiff(samples, self.samples).mean() < DUPLICATE_THRESHOLD:
+            return True
+        self.samples = samples
+        return False
+
+    def close(self):
+        if self.sct is not None:
+            self.sct.close()
+            self.sct = None
@@ -0,0 +1,163 @@
+import asyncio
+import base64
+import json
+import os
+import struct
+import threading
+
+import pytest
+
+pytest.importorskip('mediapipe')
+cv2 = pytest.importorskip('cv2')
+import numpy as np
+
+from analysis_service import AnalysisService, OP_CLOSE, OP_TEXT
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIDEO = os.path.join(REPO, '2.mp4')
+
+
+def serve(scenario, **kwargs):
+    # runs scenario(service, port) against a service listening on a free localhost port
+    async def main():
+        service = AnalysisService(mood=False, **kwargs)
+        port = await service.start('127.0.0.1', 0)
+        try:
+            return await asyncio.wait_for(scenario(service, port), 120)
+        finally:
+            await service.close()
+    return asyncio.run(main())
+
+
+async def request(port, method, path, body=b'', headers=()):
+    # (status, decoded JSON body) of one request on its own connection
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: localhost', 'Connection: close',
+             'Content-Length: {}'.format(len(body))]
+    lines += ['{}: {}'.format(name, value) for name, value in headers]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+    head, _, payload = (await reader.read()).partition(b'\r\n\r\n')
+    writer.close()
+    return int(head.split()[1]), json.loads(payload) if payload else None
+
+
+async def open_websocket(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n'.format(path, key).encode())
+    head = await reader.readuntil(b'\r\n\r\n')
+    assert head.split()[1] == b'101'
+    return reader, writer
+
+
+def send_text(writer, text):
+    payload = text.encode()
+    mask = os.urandom(4)
+    header = struct.pack('!BB', 0x80 | OP_TEXT, 0x80 | 126) + struct.pack('!H', len(payload)) if len(payload) >= 126 \
+        else struct.pack('!BB', 0x80 | OP_TEXT, 0x80 | len(payload))
+    writer.write(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+
+async def read_event(reader):
+    # the next event, or None when the server closed the socket
+    first, length = await reader.readexactly(2)
+    if length == 126:
+        length, = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', await reader.readexactly(8))
+    payload = await reader.readexactly(length)
+    if first & 0x0F == OP_CLOSE:
+        return None
+    return json.loads(payload)
+
+
+def short_video(path, frames=20):
+    cap = cv2.VideoCapture(VIDEO)
+    if not cap.isOpened():
+        pytest.skip('2.mp4 is not available')
+    writer = None
+    for _ in range(frames):
+        ret, frame = cap.read()
+        frame = cv2.resize(frame, (640, 360))
+        if writer is None:
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (640, 360))
+        writer.write(frame)
+    writer.release()
+    cap.release()
+    return path
+
+
+def test_health_and_errors():
+    async def scenario(service, port):
+        status, health = await request(port, 'GET', '/health')
+        assert status == 200 and health['sessions'] == 0
+        assert (await request(port, 'POST', '/sessions', b'{not json'))[0] == 400
+        assert (await request(port, 'POST', '/sessions', b'{"queue": 0}'))[0] == 400
+        assert (await request(port, 'POST', '/sessions', b'{"queue": null}'))[0] == 400
+        for length in ('abc', '-5'):  # the last Content-Length header wins
+            assert (await request(port, 'POST', '/sessions', headers=[('Content-Length', length)]))[0] == 400
+        assert (await request(port, 'GET', '/sessions/missing'))[0] == 404
+        assert (await request(port, 'DELETE', '/sessions/missing'))[0] == 404
+    serve(scenario)
+
+
+def test_full_queue_rejects_frames():
+    async def scenario(service, port):
+        # the only inference thread is kept busy, so the first frame waits for it and the
+        # second fills the queue
+        gate = threading.Event()
+        busy = asyncio.get_running_loop().run_in_executor(service.executor, gate.wait)
+        try:
+            status, session = await request(port, 'POST', '/sessions', b'{"policy": "reject", "queue": 1}')
+            assert status == 201
+            frame = cv2.imencode('.jpg', np.zeros((120, 160, 3), np.uint8))[1].tobytes()
+            path = '/sessions/{}/frames'.format(session['id'])
+            statuses = [(await request(port, 'POST', path, frame))[0] for _ in range(3)]
+            assert statuses == [202, 202, 429]
+            assert (await request(port, 'GET', '/sessions/' + session['id']))[1]['rejected_frames'] == 1
+            file = json.dumps({'path': VIDEO}).encode()
+            assert (await request(port, 'POST', '/sessions/{}/file'.format(session['id']), file))[0] == 409
+        finally:
+            gate.set()
+            await busy
+    serve(scenario, workers=1)
+
+
+def test_websocket_file_run(tmp_path):
+    video = short_video(str(tmp_path / 'short.avi'))
+
+    async def scenario(service, port):
+        session = (await request(port, 'POST', '/sessions'))[1]
+        reader, writer = await open_websocket(port, session['events'])
+        send_text(writer, json.dumps({'type': 'file', 'path': video}))
+        events = []
+        while not events or events[-1]['type'] == 'frame':
+            events.append(await read_event(reader))
+        writer.close()
+        return events
+    events = serve(scenario)
+    assert events[-1] == {'type': 'end', 'frames': 20}
+    assert [event['frame'] for event in events[:-1]] == list(range(20))
+    assert events[1]['time'] == round(1 / 30, 3)
+
+
+def test_delete_during_file_run():
+    if not os.path.isfile(VIDEO):
+        pytest.skip('2.mp4 is not available')
+
+    async def scenario(service, port):
+        session = (await request(port, 'POST', '/sessions'))[1]
+        reader, writer = await open_websocket(port, session['events'])
+        send_text(writer, json.dumps({'type': 'file', 'path': VIDEO}))
+        assert (await read_event(reader))['type'] == 'frame'
+        status, info = await request(port, 'DELETE', '/sessions/' + session['id'])
+        assert status == 200 and not info['analyzing_file']
+        event = await read_event(reader)
+        while event['type'] == 'frame':
+            event = await read_event(reader)
+        assert event['type'] == 'closed'
+        writer.close()
+        assert (await request(port, 'GET', '/sessions/' + session['id']))[0] == 404
+        assert (await request(port, 'GET', '/health'))[1]['sessions'] == 0
+    serve(scenario)
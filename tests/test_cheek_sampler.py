@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import pytest
+
+from cheek_sampler import CheekSampler
+from heart_rate import HeartRateMonitor
+from landmarks import CHEEK_L, CHEEK_R
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WIDTH, HEIGHT = 320, 240
+FPS = 30
+SKIN = np.array([90., 120., 170.])  # B, G, R
+PULSE = np.array([.33, .77, .53])  # relative strength of the blood volume pulse in B, G, R
+
+
+def synthetic_face():
+    # cheek quads with slanted sides, in normalized coordinates like FaceMesh's
+    face = np.zeros((478, 3))
+    face[CHEEK_L, :2] = [[.70, .40], [.58, .40], [.56, .55], [.74, .55]]  # top left, top right, bottom right, bottom left
+    face[CHEEK_R, :2] = [[.42, .40], [.30, .40], [.26, .55], [.44, .55]]
+    return face
+
+
+def pulse_frames(bpm, seconds, distractor_bpm=None):
+    # skin pulsing at `bpm` inside each cheek's box, and at `distractor_bpm` on the
+    # triangles between the box and the quad's slanted sides, like the eye bag and nose shading
+    face = synthetic_face()
+    inner = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    outer = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    for quad in (CHEEK_L, CHEEK_R):
+        xs, ys = face[quad, 0] * WIDTH, face[quad, 1] * HEIGHT
+        outer[int(ys.min()):int(ys.max()) + 1, int(xs.min()):int(xs.max()) + 1] = True
+        x1, x2 = sorted((int((xs[0] + xs[3]) / 2), int((xs[1] + xs[2]) / 2)))
+        inner[int(ys[:2].mean()):int(ys[2:].mean()), x1:x2] = True
+    rng = np.random.default_rng(0)
+    frames = []
+    for index in range(int(seconds * FPS)):
+        t = index / FPS
+        frame = np.full((HEIGHT, WIDTH, 3), 40, dtype=np.uint8)
+        if distractor_bpm:
+            frame[outer] = np.clip(SKIN * (1 + .3 * PULSE * np.sin(2 * np.pi * distractor_bpm / 60 * t)), 0, 255)
+        skin = SKIN * (1 + .02 * PULSE * np.sin(2 * np.pi * bpm / 60 * t)) + rng.normal(0, 1, 3)  # plus camera noise
+        frame[inner] = np.clip(skin, 0, 255)
+        frames.append(frame)
+    return face, frames
+
+
+def estimate(face, frames, fps=FPS):
+    sampler = CheekSampler()
+    monitor = HeartRateMonitor()
+    for index, frame in enumerate(frames):
+        monitor.add(index / fps, sampler.sample(frame, face))
+    return monitor.bpm
+
+
+def test_known_rate():
+    face, frames = pulse_frames(72, 12)
+    assert abs(estimate(face, frames) - 72) < 3
+
+
+def test_known_rate_ignores_quad_edges():
+    # the shading around the cheeks must not pull the estimate to another rate
+    face, frames = pulse_frames(72, 12, distractor_bpm=144)
+    assert abs(estimate(face, frames) - 72) < 3
+
+
+def test_outside_frame():
+    face = synthetic_face()
+    face[:, 0] += 2
+    assert CheekSampler().sample(np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8), face) is None
+
+
+def test_sample_video_rate():
+    # 2.mp4 reads 61-64 BPM; a cheek region picking up its shading reads the 122 BPM harmonic
+    pytest.importorskip('mediapipe')
+    cv2 = pytest.importorskip('cv2')
+    from deception_detection import DetectorSession
+    cap = cv2.VideoCapture(os.path.join(REPO, '2.mp4'))
+    if not cap.isOpened():
+        pytest.skip('2.mp4 is not available')
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    session = DetectorSession(mood_rate=0)
+    estimates = []
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            face_landmarks, hands_landmarks = session.find_face_and_hands(frame)
+            session.process_frame(frame, face_landmarks, hands_landmarks, fps=fps)
+            if session.bpm:
+                estimates.append(session.bpm)
+    finally:
+        cap.release()
+        session.close()
+    assert estimates
+    assert 55 < np.median(estimates) < 70
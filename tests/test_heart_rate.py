@@ -0,0 +1,16 @@
+from heart_rate import HISTORY, HeartRateMonitor
+
+
+def test_change_ignores_estimates_before_the_history():
+    monitor = HeartRateMonitor()
+    for second in range(5):
+        monitor.history.append(100.)
+        monitor.history_times.append(second)
+    # the face was lost for a minute, then three estimates at a steady rate
+    for second in range(65, 68):
+        monitor.history.append(70.)
+        monitor.history_times.append(second)
+    assert monitor.change() == 0
+    monitor.history.append(80.)
+    monitor.history_times.append(65 + HISTORY)
+    assert monitor.change() == 10
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+
+from landmark_cache import FRAME_BYTES, LandmarkCache, open_cache
+from landmarks import FACE_POINTS
+
+SETTINGS = [{'test': True}]
+
+
+def video_file(directory, name):
+    path = os.path.join(str(directory), name)
+    with open(path, 'wb') as f:
+        f.write(name.encode())
+    return path
+
+
+def test_unknown_frame_count_is_not_cached(tmp_path):
+    video = video_file(tmp_path, 'stream.mjpeg')
+    cache_dir = str(tmp_path / 'cache')
+    assert open_cache(video, SETTINGS, -192153584101141, cache_dir) is None
+    assert open_cache(video, SETTINGS, 0, cache_dir) is None
+    assert open_cache(video, SETTINGS, 1000, cache_dir, max_bytes=999 * FRAME_BYTES) is None
+    assert not os.path.exists(cache_dir)
+
+
+def test_round_trip(tmp_path):
+    cache = open_cache(video_file(tmp_path, 'a.mp4'), SETTINGS, 10, str(tmp_path / 'cache'))
+    face = np.random.default_rng(0).random((FACE_POINTS, 3)).astype(np.float32)
+    assert cache.get(3) is None
+    cache.put(3, face, None)
+    cached_face, hands = cache.get(3)
+    assert np.array_equal(cached_face, face) and hands is None
+
+
+def test_least_recently_used_caches_are_evicted(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    max_bytes = 250 * FRAME_BYTES  # room for two caches of 100 frames
+    videos = [video_file(tmp_path, name) for name in ('a.mp4', 'b.mp4', 'c.mp4')]
+    caches = []
+    for age, video in enumerate(videos[:2]):
+        caches.append(LandmarkCache(video, SETTINGS, 100, cache_dir, max_bytes))
+        os.utime(caches[-1].directory, (age, age))
+    LandmarkCache(videos[0], SETTINGS, 100, cache_dir, max_bytes)  # a is used again, so b is now the oldest
+    newest = LandmarkCache(videos[2], SETTINGS, 100, cache_dir, max_bytes)
+    assert os.path.isdir(caches[0].directory)
+    assert not os.path.exists(caches[1].directory)
+    assert os.path.isdir(newest.directory)
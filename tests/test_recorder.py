@@ -0,0 +1,24 @@
+import cv2
+import numpy as np
+
+from recorder import MAX_REPEAT_SECONDS, Recorder
+
+
+def frame_count(path):
+    cap = cv2.VideoCapture(path)
+    frames = 0
+    while cap.grab():
+        frames += 1
+    cap.release()
+    return frames
+
+
+def test_written_counts_frames_in_the_file(tmp_path):
+    path = str(tmp_path / 'gap.avi')
+    recorder = Recorder(path, fps=10)
+    frame = np.zeros((48, 64, 3), np.uint8)
+    for timestamp in (0, .1, .2, 60, 60.1):  # a pause longer than MAX_REPEAT_SECONDS
+        recorder.write(frame, timestamp)
+    recorder.close()
+    assert recorder.written == 3 + MAX_REPEAT_SECONDS * 10 + 2
+    assert frame_count(path) == recorder.written
@@ -0,0 +1,34 @@
+from collections import deque
+
+import numpy as np
+import pytest
+
+from ring_buffer import RingBuffer
+
+
+@pytest.mark.parametrize('capacity, edge', [(1, 0), (1, 1), (5, 0), (5, 1), (5, 2), (5, 4), (5, 5), (5, 8), (12, 3)])
+def test_sums_match_deque(capacity, edge):
+    rng = np.random.default_rng(capacity * 10 + edge)
+    buffer = RingBuffer(capacity, 0.0, edge=edge)
+    reference = deque([0.0] * capacity, maxlen=capacity)
+    edge = min(edge, capacity)
+    for value in rng.normal(size=4 * capacity + 3):
+        assert buffer.append(value) == reference[0]
+        reference.append(value)
+        values = list(reference)
+        assert buffer.sum() == pytest.approx(sum(values))
+        assert buffer.head_sum() == pytest.approx(sum(values[:edge]))
+        assert buffer.tail_sum() == pytest.approx(sum(values[capacity - edge:]))
+        assert buffer.latest() == value
+        np.testing.assert_array_equal(buffer.values(), values)
+
+
+def test_counts_match_deque():
+    rng = np.random.default_rng(0)
+    buffer = RingBuffer(7, 0, dtype=np.int64, counts=True)
+    reference = deque([0] * 7, maxlen=7)
+    for value in rng.integers(0, 4, size=40):
+        buffer.append(value)
+        reference.append(int(value))
+        for candidate in range(5):
+            assert buffer.count(candidate) == reference.count(candidate)
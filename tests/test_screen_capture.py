@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip('mss')
+
+from screen_capture import ScreenSource
+
+
+def test_rate_ignores_a_pause():
+    source = ScreenSource({'top': 0, 'left': 0, 'width': 16, 'height': 16})
+    assert source.fps is None
+    times = [i / 30 for i in range(20)] + [10 + i / 30 for i in range(10)]  # 10 s unchanged in between
+    for now in times:
+        source.measure(now)
+    assert source.fps == pytest.approx(30)
@@ -0,0 +1,89 @@
+import atexit
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+TRACE_ENV = 'LIE_DETECTOR_TRACE'  # path of a trace file to write, enables tracing in any entry point
+ROLLING_SPANS = 120  # durations kept per span name for the live statistics
+MAX_TRACE_EVENTS = 500000  # ~1 hour of a 30 fps session; later spans still count in the statistics
+
+enabled = False
+durations = {}
+events = None
+thread_names = {}
+trace_path = None
+origin = time.perf_counter()
+NO_SPAN = contextlib.nullcontext()
+
+
+class Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.start, time.perf_counter())
+
+
+def span(name):
+    # `with span('facemesh'):` times the block when tracing is enabled, and costs one
+    # global lookup when it is not
+    return Span(name) if enabled else NO_SPAN
+
+
+def record(name, start, end):
+    window = durations.get(name)
+    if window is None:
+        window = durations.setdefault(name, collections.deque(maxlen=ROLLING_SPANS))
+    window.append(end - start)
+    if events is not None and len(events) < MAX_TRACE_EVENTS:
+        thread = threading.get_ident()
+        if thread not in thread_names:
+            thread_names[thread] = threading.current_thread().name
+        events.append((name, start, end - start, thread))
+
+
+def enable(path=None):
+    # path: where to write a Chrome/Perfetto trace when the process exits
+    global enabled, events, trace_path
+    enabled = True
+    if path and trace_path is None:
+        trace_path = path
+        events = []
+        atexit.register(write_trace)
+
+
+def stats():
+    # {name: (mean ms, max ms)} over the last ROLLING_SPANS spans, slowest first
+    result = {}
+    for name, window in list(durations.items()):
+        values = list(window)
+        if values:
+            result[name] = (1000 * sum(values) / len(values), 1000 * max(values))
+    return dict(sorted(result.items(), key=lambda item: -item[1][0]))
+
+
+def write_trace(path=None):
+    # Trace Event Format, opens in chrome://tracing and ui.perfetto.dev
+    path = path or trace_path
+    if not path or events is None:
+        return
+    pid = os.getpid()
+    trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread, 'args': {'name': name}}
+             for thread, name in list(thread_names.items())]
+    trace += [{'name': name, 'ph': 'X', 'pid': pid, 'tid': thread, 'ts': round((start - origin) * 1e6, 1), 'dur': round(duration * 1e6, 1)}
+              for name, start, duration, thread in list(events)]
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
@@ -1,9 +1,12 @@
 import cv2
 import pygame
-from ffpyplayer.player import MediaPlayer
-from deception_detection import process_frame, find_face_and_hands, MAX_FRAMES
-import mediapipe as mp
+from deception_detection import DetectorSession, MAX_FRAMES, FACE_MESH_SETTINGS, HANDS_SETTINGS
+from landmark_cache import open_cache, find_face_and_hands_cached
+from pipeline import FramePipeline, LatencyController, END_OF_STREAM, LATENCY_BUDGET
 import numpy as np
+import time
+import tracing
+from tracing import span
 
 # Global variables for screen dimensions
 video_width = 640
@@ -15,75 +18,179 @@ COLOR_BACKGROUND = (20, 20, 20)
 COLOR_BUTTON = (50, 50, 50)
 COLOR_BUTTON_HOVER = (70, 70, 70)
 COLOR_TEXT = (255, 255, 255)
+COLOR_EXIT_BUTTON = (200, 0, 0)
+TEXT_CACHE_SIZE = 512  # rendered strings kept, enough for every tell at every TTL
+SPAN_LINES = 8  # slowest spans listed in the FPS panel when tracing
+SPAN_REFRESH = .5  # seconds between updates of the listed timings, so they stay readable
+
+fonts = {}
+
+def get_font(size):
+    if size not in fonts:
+        fonts[size] = pygame.font.Font(None, size)
+    return fonts[size]
+
+class Renderer:
+    # Draws playback with preallocated buffers: frames are resized and converted into reused
+    # arrays, the last of which backs the video surface itself, each distinct string is
+    # rendered once, and only the video area and the controls whose look changed are pushed
+    # to the display.
+    def __init__(self, screen):
+        self.screen = screen
+        self.video_rect = pygame.Rect(side_panel_width, 0, video_width, video_height)
+        self.resized = np.empty((video_height, video_width, 3), dtype=np.uint8)
+        self.rgb = np.empty((video_height, video_width, 3), dtype=np.uint8)
+        self.shown = np.empty((video_height, video_width, 3), dtype=np.uint8)
+        self.video = pygame.image.frombuffer(self.shown, (video_width, video_height), 'RGB')  # shares self.shown
+        self.text = {}
+        self.controls = {}  # rect -> (text, color) last drawn there
+        self.dirty = []
+        self.full = True
+        screen.fill((0, 0, 0))
 
-def draw_fps(screen, fps, x, y):
-    font = pygame.font.Font(None, 36)
-    fps_text = font.render(f'FPS: {int(fps)}', True, (0, 255, 0))
-    screen.blit(fps_text, (x, y))
-
-def draw_tells_on_frame(screen, tells, x, y):
-    font = pygame.font.Font(None, 36)
+    def render_text(self, text, color, size=36):
+        key = (text, color, size)
+        surface = self.text.get(key)
+        if surface is None:
+            if len(self.text) >= TEXT_CACHE_SIZE:
+                self.text.clear()
+            surface = self.text[key] = get_font(size).render(text, True, color)
+        return surface
+
+    def draw_text(self, text, color, x, y, size=36):
+        self.screen.blit(self.render_text(text, color, size), (x, y))
+
+    def draw_frame(self, frame, face_landmarks, hands_landmarks, draw_landmarks):
+        with span('render.frame'):
+            cv2.resize(frame, (video_width, video_height), dst=self.resized)
+            cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.rgb)
+            if draw_landmarks:
+                draw_landmarks_and_hands(self.rgb, face_landmarks, hands_landmarks)
+            cv2.flip(self.rgb, 1, dst=self.shown)  # mirrored, as the view has always been shown
+            self.screen.blit(self.video, self.video_rect)
+        self.dirty.append(self.video_rect)
+
+    def draw_control(self, rect, text, color):
+        if self.controls.get(tuple(rect)) == (text, color):
+            return
+        self.controls[tuple(rect)] = (text, color)
+        pygame.draw.rect(self.screen, color, rect)
+        text_surf = self.render_text(text, COLOR_TEXT)
+        self.screen.blit(text_surf, (rect.x + (rect.width - text_surf.get_width()) // 2, rect.y + (rect.height - text_surf.get_height()) // 2))
+        self.dirty.append(rect)
+
+    def present(self):
+        with span('render.present'):
+            if self.full:
+                pygame.display.flip()
+                self.full = False
+            else:
+                pygame.display.update(self.dirty)
+        self.dirty = []
+
+span_lines = []
+span_lines_time = 0
+
+def draw_fps(renderer, fps, x, y):
+    global span_lines, span_lines_time
+    renderer.draw_text(f'FPS: {int(fps)}', (0, 255, 0), x, y)
+    if tracing.enabled:  # rolling mean and max of the slowest spans, in the right of the view
+        if time.time() - span_lines_time > SPAN_REFRESH:
+            span_lines_time = time.time()
+            span_lines = [f'{name} {mean:.1f}/{peak:.0f} ms' for name, (mean, peak) in list(tracing.stats().items())[:SPAN_LINES]]
+        for idx, line in enumerate(span_lines):
+            renderer.draw_text(line, (0, 255, 0), side_panel_width + video_width - 220, y + idx * 20, size=22)
+
+def draw_tells_on_frame(renderer, tells, x, y):
     for idx, (key, tell) in enumerate(tells.items()):
-        tell_text = font.render(f'{tell["text"]} (TTL: {tell["ttl"]})', True, (255, 0, 0))
-        screen.blit(tell_text, (x, y + idx * 30))
-
-def draw_calibration_indicator(screen, x, y, remaining_frames):
-    font = pygame.font.Font(None, 36)
-    calib_text = font.render(f'Calibrating... {remaining_frames} frames remaining', True, (255, 255, 0))
-    screen.blit(calib_text, (x, y))
+        renderer.draw_text(f'{tell["text"]} (TTL: {tell["ttl"]})', (255, 0, 0), x, y + idx * 30)
+
+def draw_latency(renderer, controller, x, y):
+    latency = (controller.average('latency') + controller.average('render')) * 1000
+    renderer.draw_text(f'Latency: {int(latency)} ms (1/{controller.stride} frames)', (0, 255, 0), x, y, size=24)
+
+def draw_calibration_indicator(renderer, x, y, remaining_frames):
+    renderer.draw_text(f'Calibrating... {remaining_frames} frames remaining', (255, 255, 0), x, y)
+
+def connection_groups(connections, style):
+    # runs of connections sharing a drawing spec, in mediapipe's drawing order so that
+    # overlapping lines come out the same: [(color, thickness, (n, 2) index pairs)]
+    groups = []
+    for connection in connections:
+        spec = style[connection] if isinstance(style, dict) else style
+        if not groups or groups[-1][:2] != (spec.color, spec.thickness):
+            groups.append((spec.color, spec.thickness, []))
+        groups[-1][2].append(connection)
+    return [(color, thickness, np.array(pairs)) for color, thickness, pairs in groups]
+
+landmark_styles = None
+
+def get_landmark_styles():
+    # built once; mediapipe's drawing utilities look every spec up per connection per frame
+    global landmark_styles
+    if landmark_styles is None:
+        import mediapipe as mp
+        styles = mp.solutions.drawing_styles
+        landmark_styles = {
+            'face': connection_groups(mp.solutions.face_mesh.FACEMESH_TESSELATION, styles.get_default_face_mesh_tesselation_style())
+                + connection_groups(mp.solutions.face_mesh.FACEMESH_CONTOURS, styles.get_default_face_mesh_contours_style())
+                + connection_groups(mp.solutions.face_mesh.FACEMESH_IRISES, styles.get_default_face_mesh_iris_connections_style()),
+            'hand': connection_groups(mp.solutions.hands.HAND_CONNECTIONS, styles.get_default_hand_connections_style()),
+            'hand_points': styles.get_default_hand_landmarks_style(),
+            'hand_border': mp.solutions.drawing_utils.WHITE_COLOR,
+        }
+    return landmark_styles
+
+def to_pixels(points, width, height):
+    # same rounding and off-image rule as mediapipe's drawing utilities
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    visible = ((points >= 0) | np.isclose(points, 0)).all(axis=1) & ((points <= 1) | np.isclose(points, 1)).all(axis=1)
+    pixels = np.minimum(np.floor(points * (width, height)), (width - 1, height - 1))
+    return np.nan_to_num(pixels).astype(np.int32), visible
+
+def draw_connections(image, pixels, visible, groups):
+    for color, thickness, pairs in groups:
+        pairs = pairs[visible[pairs].all(axis=1)]
+        if len(pairs):
+            cv2.polylines(image, pixels[pairs], False, color, thickness)
 
 def draw_landmarks_and_hands(image, face_landmarks, hands_landmarks):
-    mp_drawing = mp.solutions.drawing_utils
-    mp_drawing_styles = mp.solutions.drawing_styles
-    if face_landmarks:
-        mp_drawing.draw_landmarks(
-            image,
-            face_landmarks,
-            mp.solutions.face_mesh.FACEMESH_TESSELATION,
-            landmark_drawing_spec=None,
-            connection_drawing_spec=mp_drawing_styles.get_default_face_mesh_tesselation_style())
-        mp_drawing.draw_landmarks(
-            image,
-            face_landmarks,
-            mp.solutions.face_mesh.FACEMESH_CONTOURS,
-            landmark_drawing_spec=None,
-            connection_drawing_spec=mp_drawing_styles.get_default_face_mesh_contours_style())
-        mp_drawing.draw_landmarks(
-            image,
-            face_landmarks,
-            mp.solutions.face_mesh.FACEMESH_IRISES,
-            landmark_drawing_spec=None,
-            connection_drawing_spec=mp_drawing_styles.get_default_face_mesh_iris_connections_style())
-    if hands_landmarks:
+    styles = get_landmark_styles()
+    height, width = image.shape[:2]
+    if face_landmarks is not None:
+        pixels, visible = to_pixels(face_landmarks, width, height)
+        draw_connections(image, pixels, visible, styles['face'])
+    if hands_landmarks is not None:
         for hand_landmarks in hands_landmarks:
-            mp_drawing.draw_landmarks(
-                image,
-                hand_landmarks,
-                mp.solutions.hands.HAND_CONNECTIONS,
-                mp_drawing_styles.get_default_hand_landmarks_style(),
-                mp_drawing_styles.get_default_hand_connections_style())
-
-def draw_button(screen, rect, text, font, is_hovered=False):
-    color = COLOR_BUTTON_HOVER if is_hovered else COLOR_BUTTON
-    pygame.draw.rect(screen, color, rect)
-    text_surf = font.render(text, True, COLOR_TEXT)
-    screen.blit(text_surf, (rect.x + (rect.width - text_surf.get_width()) // 2, rect.y + (rect.height - text_surf.get_height()) // 2))
+            pixels, visible = to_pixels(hand_landmarks, width, height)
+            draw_connections(image, pixels, visible, styles['hand'])
+            for idx in np.flatnonzero(visible):
+                spec = styles['hand_points'][idx]
+                center = tuple(pixels[idx].tolist())
+                cv2.circle(image, center, max(spec.circle_radius + 1, int(spec.circle_radius * 1.2)), styles['hand_border'], spec.thickness)
+                cv2.circle(image, center, spec.circle_radius, spec.color, spec.thickness)
+
+def draw_button(renderer, rect, text, is_hovered=False):
+    renderer.draw_control(rect, text, COLOR_BUTTON_HOVER if is_hovered else COLOR_BUTTON)
+
+def analyze_frame(session, frame, calibrated, fps, cache=None, frame_index=None, timestamp=None):
+    if cache is not None:
+        face_landmarks, hands_landmarks = find_face_and_hands_cached(cache, frame_index, frame, session)
+    else:
+        face_landmarks, hands_landmarks = session.find_face_and_hands(frame)
+    tells = session.process_frame(frame, face_landmarks, hands_landmarks, calibrated, fps=fps, timestamp=timestamp)
+    tells = {key: dict(tell) for key, tell in tells.items()}  # snapshot for the render thread
+    return frame, face_landmarks, hands_landmarks, tells
 
 def play_video(file_path, screen, draw_landmarks=False):
     pygame.display.set_caption('Video Playback')
     clock = pygame.time.Clock()
-    font = pygame.font.Font(None, 36)
+    renderer = Renderer(screen)
 
+    from ffpyplayer.player import MediaPlayer
     cap = cv2.VideoCapture(file_path)
     player = MediaPlayer(file_path)
-    face_mesh = mp.solutions.face_mesh.FaceMesh(
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5)
-    hands = mp.solutions.hands.Hands(
-        max_num_hands=2,
-        min_detection_confidence=0.7)
+    session = DetectorSession()
 
     exit_button = pygame.Rect(10, 10, 80, 30)
     play_button = pygame.Rect(10, 50, 80, 30)
@@ -94,6 +201,19 @@ def play_video(file_path, screen, draw_landmarks=False):
     is_paused = False
     calibrated = False
     calibration_frames = 0
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cache = open_cache(file_path, [FACE_MESH_SETTINGS, HANDS_SETTINGS], int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    def read_indexed():
+        frame_index = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        ret, frame = cap.read()
+        return ret, (frame_index, frame)
+
+    def rewind():
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        player.seek(0, relative=False)
+
+    pipeline = FramePipeline(read_indexed, lambda item, timestamp: analyze_frame(session, item[1], calibrated, fps, cache, item[0])).start()
 
     while running:
         for event in pygame.event.get():
@@ -104,80 +224,72 @@ def play_video(file_path, screen, draw_landmarks=False):
                     running = False
                 if play_button.collidepoint(event.pos):
                     is_paused = False
+                    pipeline.resume()
                 if pause_button.collidepoint(event.pos):
                     is_paused = True
+                    pipeline.pause()
                 if stop_button.collidepoint(event.pos):
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                    player.seek(0, relative=False)
+                    pipeline.run_in_capture(rewind)
                     is_paused = True
+                    pipeline.pause()
                 if recalibrate_button.collidepoint(event.pos):
                     calibrated = False
                     calibration_frames = 0
 
         if not is_paused:
-            ret, frame = cap.read()
-            if not ret:
+            result = pipeline.get(timeout=.1)
+            if result is END_OF_STREAM:
                 break
+            if result is None:
+                continue
+            frame, face_landmarks, hands_landmarks, tells = result
             audio_frame, val = player.get_frame(show=False)
-            face_landmarks, hands_landmarks = find_face_and_hands(frame, face_mesh, hands)
-            tells = process_frame(frame, face_landmarks, hands_landmarks, calibrated, fps=cap.get(cv2.CAP_PROP_FPS))
             calibration_frames += 1
             if calibration_frames >= MAX_FRAMES:
                 calibrated = True
 
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = cv2.resize(frame, (video_width, video_height))
-
-            if draw_landmarks:
-                draw_landmarks_and_hands(frame, face_landmarks, hands_landmarks)
-
-            frame = np.rot90(frame)
-            frame = pygame.surfarray.make_surface(frame)
-
-            screen.fill((0, 0, 0))
-            screen.blit(frame, (side_panel_width, 0))
-
-            pygame.draw.rect(screen, (200, 0, 0), exit_button)
-            exit_text = font.render('Exit', True, (255, 255, 255))
-            screen.blit(exit_text, (20, 10))
+            renderer.draw_frame(frame, face_landmarks, hands_landmarks, draw_landmarks)
+            renderer.draw_control(exit_button, 'Exit', COLOR_EXIT_BUTTON)
 
             if not calibrated:
-                draw_calibration_indicator(screen, side_panel_width + 10, 10, MAX_FRAMES - calibration_frames)
+                draw_calibration_indicator(renderer, side_panel_width + 10, 10, MAX_FRAMES - calibration_frames)
             else:
-                draw_fps(screen, clock.get_fps(), side_panel_width + 10, 10)
-                draw_tells_on_frame(screen, tells, side_panel_width + 10, 50)
+                draw_fps(renderer, clock.get_fps(), side_panel_width + 10, 10)
+                draw_tells_on_frame(renderer, tells, side_panel_width + 10, 50)
 
-            draw_button(screen, play_button, 'Play', font, play_button.collidepoint(pygame.mouse.get_pos()))
-            draw_button(screen, pause_button, 'Pause', font, pause_button.collidepoint(pygame.mouse.get_pos()))
-            draw_button(screen, stop_button, 'Stop', font, stop_button.collidepoint(pygame.mouse.get_pos()))
-            draw_button(screen, recalibrate_button, 'Recalibrate', font, recalibrate_button.collidepoint(pygame.mouse.get_pos()))
+            draw_button(renderer, play_button, 'Play', play_button.collidepoint(pygame.mouse.get_pos()))
+            draw_button(renderer, pause_button, 'Pause', pause_button.collidepoint(pygame.mouse.get_pos()))
+            draw_button(renderer, stop_button, 'Stop', stop_button.collidepoint(pygame.mouse.get_pos()))
+            draw_button(renderer, recalibrate_button, 'Recalibrate', recalibrate_button.collidepoint(pygame.mouse.get_pos()))
 
-            pygame.display.flip()
+            renderer.present()
             clock.tick(30)
 
+    pipeline.stop()
+    session.close()
+    if cache is not None:
+        cache.close()
     cap.release()
     player.close_player()
 
-def play_webcam(screen, draw_landmarks=False):
+def play_webcam(screen, draw_landmarks=False, latency_budget=LATENCY_BUDGET):
     pygame.display.set_caption('Webcam Feed')
     clock = pygame.time.Clock()
-    font = pygame.font.Font(None, 36)
+    renderer = Renderer(screen)
 
     cap = cv2.VideoCapture(0)
-    face_mesh = mp.solutions.face_mesh.FaceMesh(
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5)
-    hands = mp.solutions.hands.Hands(
-        max_num_hands=2,
-        min_detection_confidence=0.7)
+    session = DetectorSession(roi=True)
 
     exit_button = pygame.Rect(10, 10, 80, 30)
     recalibrate_button = pygame.Rect(10, 50, 140, 30)
     running = True
     calibrated = False
     calibration_frames = 0
+    fps = cap.get(cv2.CAP_PROP_FPS)
+
+    controller = LatencyController(latency_budget)
+    pipeline = FramePipeline(cap.read, lambda frame, timestamp: analyze_frame(session, frame, calibrated, fps, timestamp=timestamp),
+                             live=True, controller=controller).start()
 
     while running:
         for event in pygame.event.get():
@@ -190,41 +302,33 @@ def play_webcam(screen, draw_landmarks=False):
                     calibrated = False
                     calibration_frames = 0
 
-        ret, frame = cap.read()
-        if not ret:
+        result = pipeline.get(timeout=.1)
+        if result is END_OF_STREAM:
             break
-
-        face_landmarks, hands_landmarks = find_face_and_hands(frame, face_mesh, hands)
-        tells = process_frame(frame, face_landmarks, hands_landmarks, calibrated, fps=cap.get(cv2.CAP_PROP_FPS))
+        if result is None:
+            continue
+        frame, face_landmarks, hands_landmarks, tells = result
+        render_started = time.time()
         calibration_frames += 1
         if calibration_frames >= MAX_FRAMES:
             calibrated = True
 
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame = cv2.resize(frame, (video_width, video_height))
-
-        if draw_landmarks:
-            draw_landmarks_and_hands(frame, face_landmarks, hands_landmarks)
-
-        frame = np.rot90(frame)
-        frame = pygame.surfarray.make_surface(frame)
-
-        screen.fill((0, 0, 0))
-        screen.blit(frame, (side_panel_width, 0))
-
-        pygame.draw.rect(screen, (200, 0, 0), exit_button)
-        exit_text = font.render('Exit', True, (255, 255, 255))
-        screen.blit(exit_text, (20, 10))
+        renderer.draw_frame(frame, face_landmarks, hands_landmarks, draw_landmarks)
+        renderer.draw_control(exit_button, 'Exit', COLOR_EXIT_BUTTON)
 
         if not calibrated:
-            draw_calibration_indicator(screen, side_panel_width + 10, 10, MAX_FRAMES - calibration_frames)
+            draw_calibration_indicator(renderer, side_panel_width + 10, 10, MAX_FRAMES - calibration_frames)
         else:
-            draw_fps(screen, clock.get_fps(), side_panel_width + 10, 10)
-            draw_tells_on_frame(screen, tells, side_panel_width + 10, 50)
+            draw_fps(renderer, clock.get_fps(), side_panel_width + 10, 10)
+            draw_tells_on_frame(renderer, tells, side_panel_width + 10, 50)
 
-        draw_button(screen, recalibrate_button, 'Recalibrate', font, recalibrate_button.collidepoint(pygame.mouse.get_pos()))
+        draw_button(renderer, recalibrate_button, 'Recalibrate', recalibrate_button.collidepoint(pygame.mouse.get_pos()))
+        draw_latency(renderer, controller, side_panel_width + 10, video_height - 30)
 
-        pygame.display.flip()
-        clock.tick(30)
+        renderer.present()
+        controller.record('render', time.time() - render_started)
+        clock.tick()
 
+    pipeline.stop()
+    session.close()
     cap.release()